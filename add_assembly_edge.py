@@ -3,10 +3,11 @@
 
 import os
 import sys
-import gzip
 import logging
 import argparse
 
+from seqio import read_fastq, open_file, stream_fasta, get_seqid, FastaWriter
+
 LOG = logging.getLogger(__name__)
 
 __version__ = "1.1.0"
@@ -14,92 +15,56 @@ __author__ = ("Xingguo Zhang",)
 __email__ = "113178210@qq.com"
 __all__ = []
 
+BUFFER_SIZE = 4*1024*1024
+TOPOLOGY = "[topology=circular] [completeness=complete]"
 
-def read_fasta(file):
-    '''Read fasta file'''
-
-    if file.endswith(".gz"):
-        fp = gzip.open(file)
-    elif file.endswith(".fasta") or file.endswith(".fa"):
-        fp = open(file)
-    else:
-        raise Exception("%r file format error" % file)
-
-    seq = ''
-
-    for line in fp:
-        if type(line) == type(b''):
-            line = line.decode('utf-8')
-        line = line.strip()
-
-        if not line:
-            continue
-        if not seq:
-            seq += "%s\n" % line.strip(">").split()[0]
-            continue
-        if line.startswith(">"):
-            line = line.strip(">").split()[0]
-            seq = seq.split('\n')
-
-            yield seq[0], seq[1]
-            seq = ''
-            seq += "%s\n" % line
-        else:
-            seq += line
 
-    seq = seq.split('\n')
-    if len(seq)==2:
-        yield seq[0], seq[1]
+def add_assembly_edge(genome, overlap=5500, wrap=0):
+    '''Append the first overlap bases of every sequence to its end
 
-
-def read_fastq(file):
-    '''Read fastq file'''
-
-    if file.endswith(".gz"):
-        fp = gzip.open(file)
-    elif file.endswith(".fastq") or file.endswith(".fq"):
-        fp = open(file)
-    else:
-        raise Exception("%r file format error" % file)
-
-    seq = ''
-
-    for line in fp:
-        if type(line) == type(b''):
-            line = line.decode('utf-8')
-        line = line.strip()
-
-        if not line:
-            continue
-        if not seq:
-            seq += "%s\n" % line.strip("@").split()[0]
-            continue
-        if line.startswith('@'):
-            line = line.strip("@").split()[0]
-            seq = seq.split('\n')
-
-            yield seq[0], seq[1]
-            seq = ''
-            seq = "%s\n" % line
-        else:
-            seq += "%s\n" % line
-
-    if len(seq.split('\n'))==5:
-        seq = seq.split('\n')
-        yield seq[0], seq[1]
-
-
-def add_assembly_edge(genome):
+    Fasta records are streamed, only the first overlap bases of a record are
+    kept and the body is written (wrapped) as it is read.
+    '''
 
     if genome.endswith(".fastq") or genome.endswith(".fq") or genome.endswith(".fastq.gz") or genome.endswith(".fq.gz"):
         fh = read_fastq(genome)
     elif genome.endswith(".fasta") or genome.endswith(".fa") or genome.endswith(".fasta.gz") or genome.endswith(".fa.gz"):
-        fh = read_fasta(genome)
+        fh = None
     else:
         raise Exception("%r file format error" % genome)
 
-    for seqid,seq in fh:
-        print(">%s [topology=circular] [completeness=complete]\n%s%s" % (seqid, seq, seq[:5500]))
+    sys.stdout.flush()
+    out = open(sys.stdout.fileno(), 'wb', BUFFER_SIZE, closefd=False)
+    writer = FastaWriter(out, wrap)
+
+    if fh is not None:
+        for seqid, seq in fh:
+            seq = seq.encode('utf-8')
+            writer.write_record("%s %s" % (seqid, TOPOLOGY), [seq, seq[:overlap]])
+        out.close()
+        return 0
+
+    fp = open_file(genome)
+    prefix = None
+    for header, data in stream_fasta(fp):
+        if header is not None:
+            if prefix is not None:
+                writer.write(b"".join(prefix))
+                writer.end_record()
+            writer.start_record("%s %s" % (get_seqid(header), TOPOLOGY))
+            prefix = []
+            need = overlap
+            continue
+        if need > 0:
+            prefix.append(data[:need])
+            need -= len(prefix[-1])
+        writer.write(data)
+
+    if prefix is not None:
+        writer.write(b"".join(prefix))
+        writer.end_record()
+    fp.close()
+    out.close()
 
     return 0
 
@@ -107,6 +72,10 @@ def add_assembly_edge(genome):
 def add_args(parser):
 
     parser.add_argument('fasta', help='')
+    parser.add_argument('-l', '--overlap', metavar='INT', type=int, default=5500,
+        help='Bases from the start appended to the end, default=5500.')
+    parser.add_argument('-w', '--wrap', metavar='INT', type=int, default=0,
+        help='Bases per output line, default=0 (one line per sequence).')
     return parser
 
 
@@ -124,6 +93,7 @@ name:
     add_assembly_edge.py Add overlap to the ringed genome
 attention:
     add_assembly_edge.py assembly.fasta >assembly_new.fasta
+    add_assembly_edge.py assembly.fasta --overlap 10000 --wrap 80 >assembly_new.fasta
 
 version: %s
 contact:  %s <%s>\
@@ -132,7 +102,7 @@ contact:  %s <%s>\
     parser = add_args(parser)
     args = parser.parse_args()
 
-    add_assembly_edge(args.fasta)
+    add_assembly_edge(args.fasta, args.overlap, args.wrap)
 
 
 if __name__ == "__main__":
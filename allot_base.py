@@ -4,10 +4,16 @@
 import re
 import os
 import sys
-import gzip
+import heapq
 import logging
 import argparse
 
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from seqio import read_fasta, read_fastq, open_file, iter_fasta, iter_fastq, get_seqid, \
+    scan_records, read_fai, GzipWriter, RangeReader, find_record_start, \
+    split_ranges, copy_range
+
 
 LOG = logging.getLogger(__name__)
 
@@ -16,73 +22,7 @@ __author__ = ("Xingguo Zhang",)
 __email__ = "113178210@qq.com"
 __all__ = []
 
-
-def read_fasta(file):
-    '''Read fasta file'''
-
-    if file.endswith(".gz"):
-        fa = gzip.open(file)
-    elif file.endswith(".fasta") or file.endswith(".fa"):
-        fa = open(file)
-    else:
-        raise Exception("%r file format error" % file)
-
-    seq = ''
-    for line in fa:
-        if type(line) == type(b''):
-            line = line.decode('utf-8')
-        line = line.strip()
-
-        if not line:
-            continue
-        if line.startswith(">"):
-            seq = seq.split('\n')
-            if len(seq)==2:
-                yield seq[0], seq[1]
-            seq = ''
-            line = line.strip(">").split()[0]
-            seq += "%s\n" % line
-            continue
-        seq += line
-
-    seq = seq.split('\n')
-    if len(seq)==2:
-        yield seq[0], seq[1]
-    fa.close()
-
-
-def read_fastq(file):
-    '''Read fastq file'''
-
-    if file.endswith(".gz"):
-        fp = gzip.open(file, 'r')
-    elif file.endswith(".fastq") or file.endswith(".fq"):
-        fp = open(file)
-    else:
-        raise Exception("%r file format error" % file)
-
-    seq = []
-    for line in fp:
-        if type(line) == type(b''):
-            line = line.decode('utf-8')
-        line = line.strip()
-
-        if not line:
-            continue
-        if line.startswith("@") and (len(seq)==0 or len(seq)>=5):
-            seq = []
-            seq.append(line.strip("@").split()[0])
-            continue
-        if line.startswith("@") and len(seq)==4:
-            yield seq[0], seq[1]
-            seq = []
-            seq.append(line.strip("@").split()[0])
-            continue
-        seq.append(line)
-
-    if len(seq)==4:
-        yield seq[0], seq[1]
-    fp.close()
+BUFFER_SIZE = 1024*1024
 
 
 def gmk2pb(string):
@@ -150,6 +90,124 @@ def allot_base(file, name, base):
     print(fname)
 
 
+def iter_records(file):
+
+    fp = open_file(file)
+
+    if file.endswith(".fastq") or file.endswith(".fq") or file.endswith(".fastq.gz") or file.endswith(".fq.gz"):
+        for record in iter_fastq(fp):
+            yield record[0], record[1]
+    else:
+        for record in iter_fasta(fp):
+            yield record
+    fp.close()
+
+
+def read_lengths(file):
+    '''Return the length of every record, from the .fai when there is a current one'''
+
+    fai = "%s.fai" % file
+    lengths = array('L')
+
+    if os.path.exists(fai) and os.path.getmtime(fai) >= os.path.getmtime(file):
+        LOG.info("Reading lengths from %r" % fai)
+        lengths.extend(entry[1] for entry in read_fai(fai).values())
+    elif file.endswith(".fasta") or file.endswith(".fa"):
+        lengths.extend(entry[1] for entry in scan_records(file))
+    else:
+        lengths.extend(len(seq) for seqid, seq in iter_records(file))
+
+    return lengths
+
+
+def pack_shards(lengths, shards):
+    '''Assign records to shards longest first, always to the shard with the fewest bases'''
+
+    heap = [(0, i) for i in range(shards)]
+    assign = array('H', [0]) * len(lengths)
+
+    for n in sorted(range(len(lengths)), key=lengths.__getitem__, reverse=True):
+        base, i = heapq.heappop(heap)
+        assign[n] = i
+        heapq.heappush(heap, (base + lengths[n], i))
+
+    LOG.info("Shard bases: %s" % ", ".join("{0:,}".format(base) for base, i in sorted(heap, key=lambda x: x[1])))
+    return assign
+
+
+def allot_shards(file, name, shards, compress=False, threads=4):
+    '''Split the file into shards with about the same number of bases'''
+
+    lengths = read_lengths(file)
+    assign = pack_shards(lengths, shards)
+    pool = None
+    outputs = []
+
+    for i in range(shards):
+        fname = "%s.%s.fa" % (name, i+1)
+        if compress:
+            if pool is None:
+                pool = ThreadPoolExecutor(max_workers=threads)
+            outputs.append(GzipWriter("%s.gz" % fname, pool))
+        else:
+            outputs.append(open(fname, 'wb', BUFFER_SIZE))
+
+    n = -1
+    for n, (header, seq) in enumerate(iter_records(file)):
+        outputs[assign[n]].write(b">%s\n%s\n" % (get_seqid(header).encode('utf-8'), seq))
+    if n+1 != len(lengths):
+        raise Exception("%r changed while splitting, %s records indexed but %s read" % (file, len(lengths), n+1))
+
+    for output in outputs:
+        output.close()
+        print(check_path(output.name))
+    if pool is not None:
+        pool.shutdown()
+
+
+def bytes_per_base(file, fastq=False, size=4*1024*1024):
+    '''Estimate the file bytes per base from the records at the start of the file'''
+
+    with open(file, 'rb') as fh:
+        end = find_record_start(fh, min(size, os.path.getsize(file)), fastq)
+    fp = RangeReader(file, 0, end)
+    nbase = 0
+
+    if fastq:
+        for record in iter_fastq(fp):
+            nbase += len(record[1])
+    else:
+        for header, seq in iter_fasta(fp):
+            nbase += len(seq)
+    fp.close()
+
+    return end*1.0/max(nbase, 1)
+
+
+def allot_raw(file, name, base, shards=0):
+    '''Split an uncompressed file by byte ranges without parsing the records
+
+    The cut points are moved forward to the next record start and the ranges
+    are copied with copy_file_range/sendfile, the output keeps the input format.
+    '''
+
+    if file.endswith(".gz"):
+        raise Exception("%r is compressed, byte range splitting needs an uncompressed file" % file)
+
+    fastq = file.endswith(".fastq") or file.endswith(".fq")
+    total = os.path.getsize(file)
+
+    if shards > 0:
+        size = total//shards + 1
+    else:
+        size = int(gmk2pb(base)*bytes_per_base(file, fastq)) + 1
+
+    suffix = "fq" if fastq else "fa"
+    for lable, (start, end) in enumerate(split_ranges(file, size, fastq)):
+        fname = copy_range(file, start, end, "%s.%s.%s" % (name, lable+1, suffix))
+        print(check_path(fname))
+
+
 def add_help(parser):
 
     parser.add_argument('input',
@@ -158,6 +216,14 @@ def add_help(parser):
         help='Split base size, default=10mb.')
     parser.add_argument('-n', '--name', metavar='STR', type=str, default='out',
         help='Input file prefix name.')
+    parser.add_argument('-s', '--shards', metavar='INT', type=int, default=0,
+        help='Split into this number of shards with balanced bases instead of by --base.')
+    parser.add_argument('-z', '--gzip', action='store_true',
+        help='Gzip compress the shards on a thread pool (with --shards).')
+    parser.add_argument('-r', '--raw', action='store_true',
+        help='Split uncompressed files by byte ranges without parsing, the output keeps the input format.')
+    parser.add_argument('-t', '--threads', metavar='INT', type=int, default=4,
+        help='Compression threads, default=4.')
 
     return parser
 
@@ -177,6 +243,8 @@ name:
 attention:
     allot_base.py file.fastq
     allot_base.py file.fasta -n out -b 10mb >split.list
+    allot_base.py file.fasta -n out --shards 20 --gzip >split.list
+    allot_base.py file.fastq -n out -b 1gb --raw >split.list
 
 version: %s
 contact:  %s <%s>\
@@ -184,7 +252,12 @@ contact:  %s <%s>\
 
     args = add_help(parser).parse_args()
 
-    allot_base(args.input, args.name, args.base)
+    if args.raw:
+        allot_raw(args.input, args.name, args.base, args.shards)
+    elif args.shards > 0:
+        allot_shards(args.input, args.name, args.shards, args.gzip, args.threads)
+    else:
+        allot_base(args.input, args.name, args.base)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import gzip
+import time
+import random
+import logging
+import argparse
+import tempfile
+
+from seqio import open_file, iter_fasta, iter_fastq, read_fasta, read_fastq, is_fastq
+
+LOG = logging.getLogger(__name__)
+
+__version__ = "1.0.0"
+__author__ = ("Xingguo Zhang",)
+__email__ = "113178210@qq.com"
+__all__ = []
+
+LONG_MINLEN = 1000
+LONG_MAXLEN = 20000
+
+
+def legacy_read_fasta(file):
+    '''Line by line fasta reader used by the scripts before seqio'''
+
+    if file.endswith(".gz"):
+        fa = gzip.open(file)
+    else:
+        fa = open(file)
+
+    seq = ''
+    for line in fa:
+        if type(line) == type(b''):
+            line = line.decode('utf-8')
+        line = line.strip()
+
+        if not line:
+            continue
+        if line.startswith(">"):
+            seq = seq.split('\n')
+            if len(seq)==2:
+                yield seq[0], seq[1]
+            seq = ''
+            line = line.strip(">").split()[0]
+            seq += "%s\n" % line
+            continue
+        seq += line
+
+    seq = seq.split('\n')
+    if len(seq)==2:
+        yield seq[0], seq[1]
+    fa.close()
+
+
+def legacy_read_fastq(file):
+    '''Line by line fastq reader used by the scripts before seqio'''
+
+    if file.endswith(".gz"):
+        fp = gzip.open(file, 'r')
+    else:
+        fp = open(file)
+
+    seq = []
+    for line in fp:
+        if type(line) == type(b''):
+            line = line.decode('utf-8')
+        line = line.strip()
+
+        if not line:
+            continue
+        if line.startswith("@") and (len(seq)==0 or len(seq)>=5):
+            seq = []
+            seq.append(line.strip("@").split()[0])
+            continue
+        if line.startswith("@") and len(seq)==4:
+            yield seq[0], seq[1]
+            seq = []
+            seq.append(line.strip("@").split()[0])
+            continue
+        seq.append(line)
+
+    if len(seq)==4:
+        yield seq[0], seq[1]
+    fp.close()
+
+
+def write_long_fastq(file, size, minlen=LONG_MINLEN, maxlen=LONG_MAXLEN, seed=1):
+    '''Write a synthetic long read fastq of about size MB, the read lengths are
+    uniform between minlen and maxlen like HiFi and nanopore reads'''
+
+    rand = random.Random(seed)
+    bases = "".join(rand.choice("ACGT") for i in range(maxlen*2)).encode('ascii')
+    quals = "".join(chr(rand.randint(33, 73)) for i in range(maxlen*2)).encode('ascii')
+    total = 0
+    number = 0
+
+    with open(file, 'wb') as fo:
+        while total < size*1e6:
+            length = rand.randint(minlen, maxlen)
+            start = rand.randint(0, maxlen)
+            number += 1
+            total += fo.write(b"@long%d\n%s\n+\n%s\n" % (number,
+                bases[start:start+length], quals[start:start+length]))
+
+    return file
+
+
+def iter_bytes(file):
+
+    fp = open_file(file)
+
+    if is_fastq(file):
+        for record in iter_fastq(fp):
+            yield record[0], record[1]
+    else:
+        for record in iter_fasta(fp):
+            yield record
+    fp.close()
+
+
+def timing(reader, file):
+
+    number = 0
+    bases = 0
+    start = time.time()
+
+    for seqid, seq in reader(file):
+        number += 1
+        bases += len(seq)
+
+    return number, bases, time.time()-start
+
+
+def bench_seqio(files, long_fastq=0):
+
+    readers = [
+        ("legacy", lambda x: legacy_read_fastq(x) if is_fastq(x) else legacy_read_fasta(x)),
+        ("seqio", lambda x: read_fastq(x) if is_fastq(x) else read_fasta(x)),
+        ("seqio_bytes", iter_bytes),
+    ]
+
+    temp = None
+    if long_fastq > 0:
+        fd, temp = tempfile.mkstemp(prefix="bench_long.", suffix=".fastq")
+        os.close(fd)
+        LOG.info("Write %s MB of long reads to %r" % (long_fastq, temp))
+        files = list(files) + [write_long_fastq(temp, long_fastq)]
+
+    print("#File\tReader\tReads number\tBases(bp)\tSeconds\tMB/s\tSpeedup")
+    for file in files:
+        size = os.path.getsize(file)/1e6
+        base = None
+        for name, reader in readers:
+            LOG.info("Timing %s on %r" % (name, file))
+            number, bases, second = timing(reader, file)
+            if base is None:
+                base = second
+            print("{0}\t{1}\t{2:,}\t{3:,}\t{4:.2f}\t{5:.2f}\t{6:.2f}".format(
+                file, name, number, bases, second, size/max(second, 1e-9), base/max(second, 1e-9)))
+
+    if temp is not None:
+        os.remove(temp)
+
+    return 0
+
+
+def add_hlep_args(parser):
+
+    parser.add_argument('input', nargs='*', metavar='FILE', type=str,
+        help='Input fasta or fastq files, gzip is supported.')
+    parser.add_argument('--long-fastq', dest='long_fastq', metavar='INT', type=int, default=0,
+        help='Also time a synthetic fastq of this many MB with %s-%s bp reads, default=0.' % (LONG_MINLEN, LONG_MAXLEN))
+
+    return parser
+
+
+def main():
+
+    logging.basicConfig(
+        stream=sys.stderr,
+        level=logging.INFO,
+        format="[%(levelname)s] %(message)s"
+    )
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
+    description='''
+name:
+    bench_seqio.py -- Compare the throughput of seqio with the old line readers
+
+attention:
+    bench_seqio.py genome.fasta reads.fastq.gz
+    bench_seqio.py --long-fastq 250
+version: %s
+contact:  %s <%s>\
+        ''' % (__version__, ' '.join(__author__), __email__))
+
+    args = add_hlep_args(parser).parse_args()
+    if not args.input and args.long_fastq <= 0:
+        parser.error("input files or --long-fastq are required")
+
+    bench_seqio(args.input, args.long_fastq)
+
+
+if __name__ == "__main__":
+
+    main()
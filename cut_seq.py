@@ -4,10 +4,11 @@
 import os
 import re
 import sys
-import gzip
 import logging
 import argparse
 
+from seqio import read_fasta, read_fastq, get_fai, fetch_fai
+
 LOG = logging.getLogger(__name__)
 
 __version__ = "1.1.0"
@@ -16,86 +17,116 @@ __email__ = "113178210@qq.com"
 __all__ = []
 
 
-def read_fasta(file):
-    '''Read fasta file'''
+COMPLEMENT = bytes.maketrans(b"ACGTUNRYKMBDHVSWacgtunrykmbdhvsw", b"TGCAANYRMKVHDBSWtgcaanyrmkvhdbsw")
 
-    if file.endswith("fa.gz") or file.endswith("fasta.gz"):
-        fp = gzip.open(file)
-    elif file.endswith(".fasta") or file.endswith(".fa"):
-        fp = open(file)
-    else:
-        raise Exception("%r file format error" % file)
 
-    seq = ''
-    for line in fp:
-        if type(line) == type(b''):
-            line = line.decode('utf-8')
-        line = line.strip()
+def reverse_complement(seq):
 
-        if not line or line.startswith("#"):
-            continue
-        if line.startswith(">"):
-            if seq!='':
-                yield seq.split('\n')
-            seq = "%s\n" % line
-            continue
-        seq += line
+    return seq.translate(COMPLEMENT)[::-1]
 
-    if seq!='':
-        yield seq.split('\n')
-    fp.close()
 
+def write_seq(seq_id, pieces, revcomp=False):
 
-def read_fastq(file):
-    '''Read fastq file'''
-    if file.endswith(".fq.gz") or file.endswith(".fastq.gz"):
-        fp = gzip.open(file)
-    elif file.endswith(".fastq") or file.endswith(".fq"):
-        fp = open(file)
-    else:
-        raise Exception("%r file format error" % file)
+    out = sys.stdout.buffer if hasattr(sys.stdout, "buffer") else sys.stdout
+    if revcomp:
+        seq_id = "%s_rc" % seq_id
+        pieces = [reverse_complement(b"".join(pieces))]
+
+    out.write(('>%s\n' % seq_id).encode('utf-8'))
+    for piece in pieces:
+        out.write(piece)
+    out.write(b'\n')
+
+
+def read_bed(file):
+    '''Read a bed file, yield (seqid, start, end, strand) with 1-based start'''
 
-    seq = ''
-    n = 0
-    for line in fp:
-        if type(line) == type(b''):
-            line = line.decode('utf-8')
+    for line in open(file):
         line = line.strip()
 
-        if not line or line.startswith("#"):
+        if not line or line.startswith(("#", "track", "browser")):
             continue
-        n +=1
-        seq += "%s\n" % line
-        if n==4:
-            n=0
-            seq = seq.split('\n')
-            yield seq[0], seq[1]
-            seq = ''
-    fp.close()
+        line = line.split()
+        strand = line[5] if len(line) > 5 else "+"
+        yield line[0], int(line[1])+1, int(line[2]), strand
+
+
+def parse_region(string):
+    '''Parse a chr, chr:start or chr:start-end region string, end is None
+    for the end of the sequence'''
+
+    name, sep, pos = string.rpartition(":")
+    pos = pos.replace(",", "")
+
+    if not sep or not re.match(r'^\d+(-\d+)?$', pos):
+        return string, 1, None, "+"
+    start, sep, end = pos.partition("-")
+
+    return name, int(start), int(end) if end else None, "+"
+
+
+def cut_regions(files, regions, revcomp=False):
+    '''Cut a list of (seqid, start, end, strand) regions in one ordered pass,
+    an end of None cuts to the end of the sequence
+
+    Uncompressed files are read through their .fai, a file that can not be
+    indexed (irregular line lengths) is read sequentially like a gzip file.
+    '''
+
+    groups = {}
+    for name, start, end, strand in regions:
+        groups.setdefault(name, []).append((start, end, strand == "-" or revcomp))
+    for name in groups:
+        groups[name].sort(key=lambda x: x[0])
+
+    index = None
+    if not files.endswith(".gz"):
+        try:
+            index = get_fai(files)
+        except Exception as error:
+            LOG.warning("Can not index %r (%s), read it sequentially" % (files, error))
+
+    if index is None:
+        if files.endswith((".fastq.gz", ".fq.gz", ".fastq", ".fq")):
+            fh = read_fastq(files)
+        else:
+            fh = read_fasta(files)
+
+        for id, seq in fh:
+            if id not in groups:
+                continue
+            for start, end, reverse in groups.pop(id):
+                if end is None:
+                    end = len(seq)
+                seq_id = '{}_{}_{}'.format(id, start, end)
+                write_seq(seq_id, [seq[max(start-1, 0):end].encode('utf-8')], reverse)
+            if not groups:
+                break
+    else:
+        with open(files, 'rb') as fp:
+            for name in index:
+                if name not in groups:
+                    continue
+                entry = index[name]
+                for start, end, reverse in groups.pop(name):
+                    if end is None:
+                        end = entry[1]
+                    seq_id = '{}_{}_{}'.format(name, start, end)
+                    write_seq(seq_id, fetch_fai(fp, entry, start-1, end), reverse)
+
+    for name in groups:
+        LOG.info('Sequence %s does not exist, please confirm input.' % name)
 
+    return 0
 
-def read_fp(files, name, start ,end):
 
-    seq_dict = {}
+def read_fp(files, name, start ,end, revcomp=False):
 
-    if files.endswith(".fastq") or files.endswith(".fq") or files.endswith(".fastq.gz") or files.endswith(".fq.gz"):
-        fh = read_fastq(files)
-    else:
-        fh = read_fasta(files)
-
-    for id, seq in fh:
-        id = id.replace('>','').replace('@','').split()[0]
-        seq_dict[id] = seq
-
-    if name in seq_dict:
-        if int(end) <=1:
-            end = len(seq_dict[name])
-        seq_id = '{}_{}_{}'.format(name, start, end)
-        #print(seq_dict[name])
-        seq = seq_dict[name][int(start)-1:int(end)]
-        print('>%s\n%s' % (seq_id, seq))
-    else:
-        LOG.info('Sequence %s does not exist, please confirm input.' % name)
+    end = int(end)
+    if end <=1:
+        end = None
+
+    return cut_regions(files, [(name, int(start), end, "+")], revcomp)
 
 
 def add_cut_help(parser):
@@ -108,6 +139,12 @@ def add_cut_help(parser):
         help='Input the starting site of the cut.')
     parser.add_argument('-e', '--end', metavar='INT', type=int, default=1,
         help='Input cut-out termination site.')
+    parser.add_argument('-b', '--bed', metavar='FILE', type=str, default=None,
+        help='Input a bed file of regions to cut, strand "-" is reverse complemented.')
+    parser.add_argument('-r', '--region', metavar='STR', nargs='+', type=str, default=[],
+        help='Input regions to cut, format chr:start-end.')
+    parser.add_argument('--revcomp', action='store_true',
+        help='Output the reverse complement of the cut sequences.')
     return parser
 
 
@@ -126,10 +163,21 @@ name:
 attention:
     cut_seq.  genen.fasta -id scf00001
     cut_seq  genen.fasta -id scf00001 --start 2 --end 2000
+    cut_seq  genen.fasta -r scf00001:2-2000 scf00002:100-500
+    cut_seq  genen.fasta --bed regions.bed --revcomp
+
+    Uncompressed inputs are indexed once (genen.fasta.fai, samtools compatible)
+    and the requested bases are read straight from the file.
 ''')
     args = add_cut_help(parser).parse_args()
 
-    read_fp(args.input, args.id_name, args.start ,args.end)
+    if args.bed or args.region:
+        regions = [parse_region(i) for i in args.region]
+        if args.bed:
+            regions += list(read_bed(args.bed))
+        cut_regions(args.input, regions, args.revcomp)
+    else:
+        read_fp(args.input, args.id_name, args.start ,args.end, args.revcomp)
 
 
 if __name__ == "__main__":
@@ -4,9 +4,22 @@
 import os
 import re
 import sys
+import time
 import pysam
+import hashlib
 import logging
 import argparse
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from array import array
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from pbindex import get_pbi, read_pbi
 
 LOG = logging.getLogger(__name__)
 
@@ -15,6 +28,9 @@ __author__ = ("Xingguo Zhang",)
 __email__ = "113178210@qq.com"
 __all__ = []
 
+BATCH_SIZE = 1024
+QUEUE_SIZE = 16
+
 
 def gmk2pb(string):
 
@@ -47,41 +63,370 @@ def get_sample(file):
     return name
 
 
-def filter_bam(file, qvalue=0.8, minlen=500, keep='1Gb'):
+def get_budget(keep):
+    '''Return the number of bases to keep, None to keep all'''
+
+    if keep=="" or keep=="all":
+        return None
+
+    return gmk2pb(keep)
+
+
+def sample_fraction(budget, total):
+    '''Return the fraction of total bases that keeps about budget bases'''
+
+    if total <= 0:
+        return 1.0
+
+    return min(1.0, budget*1.0/total)
+
+
+def get_sampler(fraction, seed=0):
+    '''Return a function that keeps a read name with probability fraction
+
+    The name is hashed with blake2b keyed by the seed, so a read is kept or
+    not on its own, in any order, and the same reads are kept on every run.
+    '''
+
+    key = ("%s" % seed).encode('utf-8')
+    limit = int(fraction*2**64)
+
+    def keep_read(name):
+        digest = hashlib.blake2b(name.encode('utf-8'), digest_size=8, key=key).digest()
+        return int.from_bytes(digest, 'little') < limit
+
+    return keep_read
+
+
+def open_bam(file, threads=1):
 
     if file.endswith(".bam"):
-        fh = pysam.AlignmentFile(file, "rb", check_sq=False)
+        return pysam.AlignmentFile(file, "rb", check_sq=False, threads=threads)
     elif file.endswith(".sam"):
-        fh = pysam.AlignmentFile(file, 'r')
-    else:
-        raise Exception("%r file format error" % file)
+        return pysam.AlignmentFile(file, 'r', threads=threads)
 
-    name = get_sample(file)
-    fo = pysam.AlignmentFile("%s.clean.bam" % name, "wb", template=fh)
+    raise Exception("%r file format error" % file)
+
+
+def count_bases(file, qvalue=0.8, minlen=500, threads=1):
+    '''Return the bases of the reads that pass rq and length, the sequences are not read'''
+
+    fh = open_bam(file, threads)
     n = 0
 
     for line in fh:
         if line.get_tag('rq') <= qvalue:
             continue
-        if len(line.seq)<= minlen:
+        length = line.query_length
+        if length > minlen:
+            n += length
+    fh.close()
+
+    return n
+
+
+def select_pbi(pbi, qvalue=0.8, minlen=500, keep='1Gb'):
+    '''Choose the reads to keep from the rq and length columns of a .pbi
+
+    Return the indexes of the kept reads in file order, the virtual file
+    offsets of all reads, the number of reads inspected and the kept bases.
+    The --keep budget is applied here in file order, the reads inspected stop
+    at the read that hit the budget, as when the bam is read without index.
+    '''
+
+    header, data = read_pbi(pbi, ("qStart", "qEnd", "readQual", "fileOffset"))
+    budget = get_budget(keep)
+    selected = array('l')
+    number = header["reads"]
+    n = 0
+
+    for i, (qstart, qend, rq) in enumerate(zip(data["qStart"], data["qEnd"], data["readQual"])):
+        if rq <= qvalue:
+            continue
+        if qend-qstart <= minlen:
+            continue
+        if budget is not None and budget <= n:
+            number = i+1
+            break
+        selected.append(i)
+        n += qend-qstart
+
+    LOG.info("Keep %s of %s reads (%s bp) by %r" % (len(selected), header["reads"], n, pbi))
+    return selected, data["fileOffset"], number, n
+
+
+def put_item(items, item, stop):
+
+    while not stop.is_set():
+        try:
+            items.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def read_batches(fh, items, stop, batch_size=BATCH_SIZE):
+    '''Reader thread, put batches of records on the queue and None at the end'''
+
+    batch = []
+    try:
+        for line in fh:
+            batch.append(line)
+            if len(batch) >= batch_size:
+                if not put_item(items, batch, stop):
+                    return
+                batch = []
+    except Exception as error:
+        put_item(items, error, stop)
+        return
+    if batch:
+        put_item(items, batch, stop)
+    put_item(items, None, stop)
+
+
+def iter_pipeline(fh, queue_size=QUEUE_SIZE):
+    '''Yield the records of fh read on a background thread through a bounded queue
+
+    Closing the generator early (the keep budget is reached) stops the reader.
+    '''
+
+    items = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+    thread = threading.Thread(target=read_batches, args=(fh, items, stop))
+    thread.daemon = True
+    thread.start()
+
+    try:
+        while True:
+            batch = items.get()
+            if batch is None:
+                break
+            if isinstance(batch, Exception):
+                raise batch
+            for line in batch:
+                yield line
+    finally:
+        stop.set()
+        thread.join()
+
+
+class PipeWriter(object):
+    '''Write records on a background thread, batches pass through a bounded queue'''
+
+    def __init__(self, fo, batch_size=BATCH_SIZE, queue_size=QUEUE_SIZE):
+
+        self.fo = fo
+        self.batch_size = batch_size
+        self.batch = []
+        self.items = queue.Queue(maxsize=queue_size)
+        self.error = None
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+
+        while True:
+            batch = self.items.get()
+            if batch is None:
+                return
+            if self.error is not None:
+                continue
+            try:
+                for line in batch:
+                    self.fo.write(line)
+            except Exception as error:
+                self.error = error
+
+    def write(self, line):
+
+        self.batch.append(line)
+        if len(self.batch) >= self.batch_size:
+            self.items.put(self.batch)
+            self.batch = []
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+
+        if self.batch:
+            self.items.put(self.batch)
+            self.batch = []
+        self.items.put(None)
+        self.thread.join()
+        self.fo.close()
+        if self.error is not None:
+            raise self.error
+
+
+def filter_bam_pbi(file, pbi, qvalue=0.8, minlen=500, keep='1Gb', threads=1, sample_to=None, seed=0):
+    '''Filter a bam with its .pbi, only the kept records are read
+
+    Runs of consecutive kept reads are read sequentially, the file is only
+    seeked to a stored virtual offset when reads were skipped in between.
+    With sample_to the bases that pass come from the index, and the reads
+    that pass are read and sampled by name.
+    '''
+
+    selected, offsets, number, bases = select_pbi(pbi, qvalue, minlen, "all" if sample_to else keep)
+    fh = pysam.AlignmentFile(file, "rb", check_sq=False, threads=threads)
+    fo = pysam.AlignmentFile("%s.clean.bam" % get_sample(file), "wb", template=fh, threads=threads)
+    kept = len(selected)
+    keep_read = None
+    last = -2
+
+    if sample_to:
+        fraction = sample_fraction(get_budget(sample_to), bases)
+        LOG.info("Sample %.6f of %s bp in %r" % (fraction, bases, file))
+        keep_read = get_sampler(fraction, seed)
+        kept = 0
+        bases = 0
+
+    for i in selected:
+        if i != last+1:
+            fh.seek(offsets[i])
+        line = next(fh)
+        last = i
+        if keep_read is not None:
+            if not keep_read(line.query_name):
+                continue
+            kept += 1
+            bases += line.query_length
+        fo.write(line)
+
+    fh.close()
+    fo.close()
+
+    return number, kept, bases
+
+
+def filter_bam(file, qvalue=0.8, minlen=500, keep='1Gb', threads=1, sample_to=None, seed=0):
+    '''Filter a bam by rq and length, keep the first reads up to the keep bases
+
+    With sample_to, keep a uniform sample of about sample_to bases instead:
+    the bases that pass are counted from the .pbi or a pass over the record
+    lengths, and each read is kept by a seeded hash of its name with the
+    fraction sample_to/bases, in one pass over the sequences.
+
+    With threads > 1 pysam decompresses and compresses on threads and the
+    records are read and written on their own threads, connected to the
+    filter by bounded queues. Return the reads inspected (up to the one that
+    hit the keep budget), the reads kept and the kept bases.
+    '''
+
+    pbi = get_pbi(file)
+    if pbi:
+        return filter_bam_pbi(file, pbi, qvalue, minlen, keep, threads, sample_to, seed)
+
+    keep_read = None
+    if sample_to:
+        total = count_bases(file, qvalue, minlen, threads)
+        fraction = sample_fraction(get_budget(sample_to), total)
+        LOG.info("Sample %.6f of %s bp in %r" % (fraction, total, file))
+        keep_read = get_sampler(fraction, seed)
+        keep = "all"
+
+    fh = open_bam(file, threads)
+    name = get_sample(file)
+    fo = pysam.AlignmentFile("%s.clean.bam" % name, "wb", template=fh, threads=threads)
+    budget = get_budget(keep)
+    n = 0
+    number = 0
+    kept = 0
+
+    if threads > 1:
+        records = iter_pipeline(fh)
+        fo = PipeWriter(fo)
+    else:
+        records = fh
+
+    for line in records:
+        number += 1
+        if line.get_tag('rq') <= qvalue:
+            continue
+        length = line.query_length
+        if length<= minlen:
             continue
-        if keep=="" or keep=="all":
-            pass
-        elif gmk2pb(keep) <= n:
+        if budget is not None and budget <= n:
             break
-        else:
-            pass
+        if keep_read is not None and not keep_read(line.query_name):
+            continue
         fo.write(line)
-        n += len(line.seq)
+        n += length
+        kept += 1
 
+    if threads > 1:
+        records.close()
     fh.close()
     fo.close()
 
+    return number, kept, n
+
+
+def filter_task(file, qvalue, minlen, keep, threads, sample_to=None, seed=0):
+
+    start = time.time()
+    number, kept, bases = filter_bam(file, qvalue, minlen, keep, threads, sample_to, seed)
+
+    return number, kept, bases, time.time()-start
+
 
-def filter_bams(files, qvalue, minlen, keep):
+def share_threads(size, threads, free, running):
+    '''Return the threads for a file of size that starts next to the running sizes
 
-    for file in files:
-        filter_bam(file, qvalue, minlen, keep)
+    The budget is split by size between the file and the running files, and
+    the file never takes more than the free threads, but at least one.
+    '''
+
+    share = int(round(threads*size*1.0/max(size+sum(running), 1)))
+
+    return max(1, min(share, free, threads))
+
+
+def filter_bams(files, qvalue, minlen, keep, threads=1, jobs=1, sample_to=None, seed=0):
+    '''Filter the files, jobs files at the same time in worker processes, and
+    print the summary of every file in input order
+
+    The files start largest first, the threads of a finished file are given
+    to the next ones, so a large cell and many small barcodes finish together.
+    '''
+
+    sizes = [os.path.getsize(file) for file in files]
+    results = {}
+
+    if jobs <= 1 or len(files) <= 1:
+        for i, file in enumerate(files):
+            results[i] = filter_task(file, qvalue, minlen, keep, threads, sample_to, seed)
+    else:
+        jobs = min(jobs, len(files))
+        order = deque(sorted(range(len(files)), key=lambda i: sizes[i], reverse=True))
+        first = sum(sizes[i] for i in list(order)[:jobs])
+        running = {}
+        free = threads
+
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            while order or running:
+                while order and len(running) < jobs:
+                    i = order.popleft()
+                    if len(results) + len(running) < jobs:
+                        share = share_threads(sizes[i], threads, threads, [first-sizes[i]])
+                    else:
+                        share = share_threads(sizes[i], threads, free, [sizes[j] for j, t in running.values()])
+                    free -= share
+                    LOG.info("Filter %r with %s threads" % (files[i], share))
+                    running[pool.submit(filter_task, files[i], qvalue, minlen, keep, share, sample_to, seed)] = (i, share)
+                done, pending = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    i, share = running.pop(future)
+                    results[i] = future.result()
+                    free += share
+
+    print("#File\tRecords read\tRecords out\tBases kept(bp)\tSeconds\tMB/s")
+    for i, file in enumerate(files):
+        number, kept, bases, second = results[i]
+        print("{0}\t{1:,}\t{2:,}\t{3:,}\t{4:.2f}\t{5:.2f}".format(
+            file, number, kept, bases, second, sizes[i]/1e6/max(second, 1e-9)))
 
 
 def add_hlep_args(parser):
@@ -94,6 +439,14 @@ def add_hlep_args(parser):
         help='Input the minimum read length for filtering, default=500.')
     parser.add_argument('-k', '--keep', metavar='STR', type=str, default='all',
         help='Number of bases reserved, default=all.')
+    parser.add_argument('--sample-to', dest='sample_to', metavar='STR', type=str, default=None,
+        help='Keep a uniform sample of about this many bases of the reads that pass, in place of --keep.')
+    parser.add_argument('--seed', metavar='INT', type=int, default=0,
+        help='Seed of the read name hash used by --sample-to, default=0.')
+    parser.add_argument('-t', '--threads', metavar='INT', type=int, default=1,
+        help='Compression threads, more than 1 also reads, filters and writes on separate threads, default=1.')
+    parser.add_argument('-j', '--jobs', metavar='INT', type=int, default=1,
+        help='Number of files filtered at the same time, --threads is shared between them by file size, default=1.')
 
     return parser
 
@@ -112,13 +465,21 @@ name:
 
 attention:
     filter_bam.py -i *.bam
+    filter_bam.py -i subreads.bam --keep 10Gb --threads 8
+    filter_bam.py -i *.bam --jobs 8 --threads 32 >filter.summary.tsv
+    filter_bam.py -i subreads.bam --sample-to 10Gb --seed 1
+
+    When a bam has a PacBio index (.bam.pbi) the reads are chosen from the index
+    and only the kept records are read from the bam. --keep keeps the first reads,
+    --sample-to keeps the same reads on every run with the same --seed.
 version: %s
 contact:  %s <%s>\
         ''' % (__version__, ' '.join(__author__), __email__))
 
     args = add_hlep_args(parser).parse_args()
 
-    filter_bams(args.input, args.qvalue, args.minlen, args.keep)
+    filter_bams(args.input, args.qvalue, args.minlen, args.keep, args.threads, args.jobs,
+        args.sample_to, args.seed)
 
 
 if __name__ == "__main__":
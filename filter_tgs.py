@@ -4,7 +4,6 @@
 import os
 import re
 import sys
-import gzip
 import pysam
 import logging
 import argparse
@@ -12,6 +11,11 @@ import matplotlib
 matplotlib.use('Agg')
 
 from matplotlib import pyplot as plt
+from concurrent.futures import ThreadPoolExecutor
+from seqio import read_fasta, read_fastq, GzipWriter, iter_mean_quality
+from pbindex import get_pbi, pbi_lengths
+from readstat import LengthStat, store_counts, write_hist, bin_counts, HIST_SUFFIX
+from statcache import open_cache
 
 
 LOG = logging.getLogger(__name__)
@@ -21,144 +25,123 @@ __author__ = ("Xingguo Zhang",)
 __email__ = "113178210@qq.com"
 __all__ = []
 
+BUFFER_SIZE = 4*1024*1024
 
-def read_fasta(file):
-    '''Read fasta file'''
 
-    if file.endswith(".gz"):
-        fa = gzip.open(file)
-    elif file.endswith(".fasta") or file.endswith(".fa"):
-        fa = open(file)
-    else:
-        raise Exception("%r file format error" % file)
+def read_bam(file, threads=1):
+    '''Yield the name, query_length and record of every read, the sequence is
+    decoded later and only for the reads that pass'''
 
-    seq = ''
-    for line in fa:
-        if type(line) == type(b''):
-            line = line.decode('utf-8')
-        line = line.strip()
+    fp = pysam.AlignmentFile(file, 'rb', check_sq=False, threads=threads)
 
-        if not line:
-            continue
-        if line.startswith(">"):
-            seq = seq.split('\n')
-            if len(seq)==2:
-                yield seq[0], seq[1]
-            seq = ''
-            line = line.strip(">").split()[0]
-            seq += "%s\n" % line
-            continue
-        seq += line
+    LOG.info('process %r' % file)
+    for record in fp:
+        yield record.query_name, record.query_length, record
+    fp.close()
 
-    seq = seq.split('\n')
-    if len(seq)==2:
-        yield seq[0], seq[1]
-    fa.close()
 
+def read_text(fh):
 
-def read_fastq(file):
-    '''Read fastq file'''
+    for seqid, seq in fh:
+        yield seqid, len(seq), seq
 
-    if file.endswith(".gz"):
-        fp = gzip.open(file, 'r')
-    elif file.endswith(".fastq") or file.endswith(".fq"):
-        fp = open(file)
-    else:
-        raise Exception("%r file format error" % file)
 
-    seq = []
-    for line in fp:
-        if type(line) == type(b''):
-            line = line.decode('utf-8')
-        line = line.strip()
+def read_quality(fh, min_q):
+    '''Like read_text for full fastq records, seq is None for the reads whose
+    mean quality is below min_q'''
 
-        if not line:
-            continue
-        if line.startswith("@") and (len(seq)==0 or len(seq)>=5):
-            seq = []
-            seq.append(line.strip("@").split()[0])
-            continue
-        if line.startswith("@") and len(seq)==4:
-            yield seq[0], seq[1]
-            seq = []
-            seq.append(line.strip("@").split()[0])
-            continue
-        seq.append(line)
+    for (seqid, seq, plus, quality), mean in iter_mean_quality(fh):
+        yield seqid, len(seq), seq if mean >= min_q else None
 
-    if len(seq)==4:
-        yield seq[0], seq[1]
-    fp.close()
 
+def open_output(name, compress=None, threads=1):
+    '''Open the clean reads output, gz and bgzf outputs are compressed in
+    independent blocks on a thread pool and written in order'''
 
-def read_bam(file):
+    if not compress:
+        return open('%s.clean.fasta' % name, 'wb', BUFFER_SIZE)
+    if compress not in ("gz", "bgzf"):
+        raise Exception("%r compression is not supported, use gz or bgzf" % compress)
 
-    fp = pysam.AlignmentFile(file, 'rb', check_sq=False)
+    pool = ThreadPoolExecutor(max_workers=max(threads, 1))
+    return GzipWriter('%s.clean.fasta.gz' % name, pool, bgzf=compress=="bgzf")
 
-    LOG.info('process %r' % file)
-    for record in fp:
-        yield record.qname, record.seq
 
+def filter_reads(files, name, minlen=1000, threads=1, cache=None, compress=None, min_q=0):
+    '''Write the reads longer than minlen, return the statistics of the raw and the
+    filtered reads, they are updated as the reads pass so memory stays constant
 
-def filter_reads(files, name, minlen=1000):
+    Each file is counted exactly and merged into the exact totals.
+    '''
 
-    raw_length = []
-    filter_length = []
-    output = open('%s.clean.fasta' % name, 'w')
+    raw_stat = LengthStat()
+    filter_stat = LengthStat()
+    output = open_output(name, compress, threads)
 
     for file in files:
+        if min_q > 0 and not file.endswith(('.fq', '.fastq', '.fq.gz', '.fastq.gz')):
+            LOG.warning("%r has no base qualities, --min-mean-q is not applied" % file)
+        counted = False
+        file_stat = LengthStat()
+        file_filter = LengthStat()
         if file.endswith('.fa') or file.endswith('.fasta') or file.endswith('.fa.gz') or file.endswith('.fasta.gz'):
-            fh = read_fasta(file)
+            fh = read_text(read_fasta(file))
+        elif (file.endswith('.fq') or file.endswith('.fastq') or file.endswith('.fq.gz') or file.endswith('.fastq.gz')) and min_q > 0:
+            fh = read_quality(read_fastq(file, full=True), min_q)
         elif file.endswith('.fq') or file.endswith('.fastq') or file.endswith('.fq.gz') or file.endswith('.fastq.gz'):
-            fh = read_fastq(file)
+            fh = read_text(read_fastq(file))
         elif file.endswith('.bam'):
-            fh = read_bam(file)
+            pbi = get_pbi(file)
+            if pbi:
+                file_stat.extend(pbi_lengths(pbi, threads))
+                counted = True
+                if max(file_stat.counts or [0]) <= minlen:
+                    LOG.info("No read of %r is longer than %s, skip it" % (file, minlen))
+                    raw_stat.update(file_stat)
+                    store_counts(cache, file, file_stat.counts)
+                    continue
+            fh = read_bam(file, threads)
         else:
             raise Exception('Unknown format!')
+        bam = file.endswith('.bam')
 
-        for seqid, seq in fh:
-            seqlen = len(seq)
-
-            raw_length.append(seqlen)
-            if seqlen<=minlen:
+        for seqid, seqlen, seq in fh:
+            if not counted:
+                file_stat.add(seqlen)
+            if seqlen<=minlen or seq is None:
                 continue
-            filter_length.append(seqlen)
-            output.write('>%s\n%s\n' %(seqid, seq))
+            file_filter.add(seqlen)
+            if bam:
+                seq = seq.query_sequence
+            output.write(('>%s\n%s\n' %(seqid, seq)).encode('utf-8'))
+        raw_stat.update(file_stat)
+        filter_stat.update(file_filter)
+        store_counts(cache, file, file_stat.counts)
     output.close()
+    if compress:
+        output.pool.shutdown()
 
-    return raw_length, filter_length
-
-
-def n50(lengths):
-
-    sumlen = sum(lengths)
-    acculen = 0
-
-    for i in sorted(lengths, reverse=True):
-        acculen += i
-        if acculen >= sumlen*0.5:
-            break
+    return raw_stat, filter_stat
 
-    return i
 
-
-def stat_len(lengths):
+def stat_len(counts):
 
     k10 = 0
     k20 = 0
     k40 = 0
 
-    for i in sorted(lengths, reverse=True):
+    for i, number in counts.items():
         if i<10000:
-            break
-        k10 += 1
+            continue
+        k10 += number
         if i >20000:
-            k20 += 1
+            k20 += number
         if i >40000:
-            k40 += 1
+            k40 += number
     return k10, k20, k40
 
 
-def plot_read_length(lengths, name, xmin=0, xmax=35000, bins=100):
+def plot_read_length(counts, name, xmin=0, xmax=35000, bins=100):
 
     #plt.style.use('ggplot')
     plt.switch_backend('agg')
@@ -170,7 +153,11 @@ def plot_read_length(lengths, name, xmin=0, xmax=35000, bins=100):
 #    ax.spines['left'].set_visible(False) #去掉左边框
 #    ax.spines['right'].set_visible(False) #去掉右边框
 
-    ax.hist(lengths, bins=bins, range=(xmin, xmax), histtype='stepfilled', alpha=0.75)
+    edges, values = bin_counts(counts, bins, xmin, xmax)
+    if hasattr(ax, "stairs"):
+        ax.stairs(values, edges, fill=True, alpha=0.75)
+    else:
+        ax.bar(edges[:-1], values, width=edges[1]-edges[0], align='edge', alpha=0.75)
 
     ax.set_xlim(xmin, xmax)
     font = {'weight': 'bold','size': 12,}
@@ -186,6 +173,16 @@ def add_hlep(parser):
         help='Input reads file(fasta, fatsq, bam).')
     parser.add_argument('--minlen', metavar='INT', type=int, default=1000,
         help='Set the minimum length of filtered reads, default=1000.')
+    parser.add_argument('-q', '--min-mean-q', dest='min_mean_q', metavar='FLOAT', type=float, default=0,
+        help='Set the minimum mean quality of fastq reads (Phred, from the mean error rate), default=0.')
+    parser.add_argument('-t', '--threads', metavar='INT', type=int, default=1,
+        help='Decompression threads for bam input and compression threads for --compress, default=1.')
+    parser.add_argument('-z', '--compress', metavar='STR', choices=['gz', 'bgzf'], default=None,
+        help='Write name.clean.fasta.gz compressed as gz or bgzf on --threads threads.')
+    parser.add_argument('--hist', action='store_true',
+        help='Write the raw and filtered read length histograms to name.raw.lenhist and name.clean.lenhist.')
+    parser.add_argument('--no-cache', dest='no_cache', action='store_true',
+        help='Do not store the length histograms of the inputs in the statistics cache.')
     parser.add_argument('--xmin', metavar="INT", type=int, default=0,
         help='Minimum number of x axis, default=0.')
     parser.add_argument('--xmax', metavar="INT", type=int, default=80000,
@@ -214,21 +211,32 @@ attention:
     filter_tgs -i *.bam
     filter_tgs -i *.fa
     filter_tgs -i *.fq
+    filter_tgs -i *.bam --threads 4
+    filter_tgs -i *.bam --threads 8 --compress bgzf
+    filter_tgs -i ont.fq.gz --minlen 1000 --min-mean-q 10
+
+    The raw read lengths of a bam are read from its PacBio index (.bam.pbi) when it exists.
+    The length histogram of every input is stored in the statistics cache for
+    stat_barcode.py and plot_read_length.py, --hist writes them as .lenhist files
+    that both scripts read in place of the reads.
 version: %s
 contact:  %s <%s>\
     ''' % (__version__, ' '.join(__author__), __email__))
 
     args = add_hlep(parser).parse_args()
-    raw_length, filter_length = filter_reads(args.input, args.name, args.minlen)
-
-    plot_read_length(raw_length, args.name, args.xmin, args.xmax, args.bins)
-
-    k10, k20, k40 = stat_len(raw_length)
-    fk10, fk20, fk40 = stat_len(filter_length)
-    raw_bases = sum(raw_length)
-    filter_bases = sum(filter_length)
-    raw_number = len(raw_length)
-    filter_number = len(filter_length)
+    raw_stat, filter_stat = filter_reads(args.input, args.name, args.minlen, args.threads,
+        open_cache(args.no_cache), args.compress, args.min_mean_q)
+
+    plot_read_length(raw_stat.counts, args.name, args.xmin, args.xmax, args.bins)
+    if args.hist:
+        write_hist("%s.raw%s" % (args.name, HIST_SUFFIX), raw_stat.counts)
+        write_hist("%s.clean%s" % (args.name, HIST_SUFFIX), filter_stat.counts)
+
+    k10, k20, k40 = stat_len(raw_stat.counts)
+    fk10, fk20, fk40 = stat_len(filter_stat.counts)
+    raw_bases, raw_number, raw_mean, raw_max, raw_nx = raw_stat.stat([50])
+    filter_bases, filter_number, filter_mean, filter_max, filter_nx = filter_stat.stat([50])
+    total = max(raw_number, 1)
     output = open('%s.reads_stat.tsv' % args.name, 'w')
 
     output.write("""\
@@ -236,8 +244,8 @@ contact:  %s <%s>\
 Raw Reads\t{0:,}\t{1:,}\t{2:,.2f}\t{3:,}\t{4:,}\t{5:.2f}\t{6:.2f}\t{7:.2f}
 Filtered Reads\t{8:,}\t{9:,}\t{10:,.2f}\t{11:,}\t{12:,}\t{13:.2f}\t{14:.2f}\t{15:.2f}
 """.format(
-        raw_bases, raw_number, raw_bases*1.0/raw_number, max(raw_length), n50(raw_length), k10*100.0/raw_number, k20*100.0/raw_number, k40*100.0/raw_number,
-        filter_bases, filter_number, filter_bases*1.0/filter_number, max(filter_length), n50(filter_length), fk10*100.0/raw_number, fk20*100.0/raw_number, fk40*100.0/raw_number
+        raw_bases, raw_number, raw_mean, raw_max, raw_nx[50], k10*100.0/total, k20*100.0/total, k40*100.0/total,
+        filter_bases, filter_number, filter_mean, filter_max, filter_nx[50], fk10*100.0/total, fk20*100.0/total, fk40*100.0/total
     ))
     output.close()
 
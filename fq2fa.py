@@ -4,10 +4,16 @@
 import os
 import re
 import sys
-import gzip
+import shutil
 import logging
+import tempfile
 import argparse
 
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from seqio import open_file, iter_fastq, get_seqid, RangeReader, split_ranges, \
+    iter_mean_quality
+
 LOG = logging.getLogger(__name__)
 
 __version__ = "1.1.0"
@@ -15,47 +21,148 @@ __author__ = ("Xingguo Zhang",)
 __email__ = "invicoun@foxmail.com"
 __all__ = []
 
+RANGE_SIZE = 64*1024*1024
+BUFFER_SIZE = 4*1024*1024
 
-def read_fastq(file):
-    '''Read fastq file'''
 
-    LOG.info("Reading message from %r" % file)
-    if file.endswith("fastq.gz") or file.endswith(".fq.gz"):
-        fp = gzip.open(file)
-    elif file.endswith(".fastq") or file.endswith(".fq"):
-        fp = open(file)
-    else:
-        raise Exception("%r file format error" % file)
+def filter_quality(records, min_q=0):
+    '''Drop the fastq records whose mean quality is below min_q'''
 
-    seq = []
-    for line in fp:
-        if isinstance(line, bytes):
-            line = line.decode('utf-8')
-        line = line.strip()
+    if min_q <= 0:
+        return records
 
-        if not line:
-            continue
-        if not seq:
-            seq.append(line.strip("@").split()[0])
-            continue
+    return (record for record, quality in iter_mean_quality(records) if quality >= min_q)
 
-        seq.append(line)
-        if len(seq) == 4:
-            yield seq
-            seq = []
 
-    fp.close()
+def convert_records(fp, fo, minlen, min_q=0):
+    '''Convert the fastq records of fp, write them to fo in blocks or return
+    them as bytes when fo is None'''
 
+    buf = []
+    size = 0
+    for header, seq, ignore, quality in filter_quality(iter_fastq(fp), min_q):
+        if len(seq) < minlen:
+            LOG.info("The length of the filter sequence %s is %s" % (get_seqid(header), len(seq)))
+            continue
+        buf.append(b">%s\n%s\n" % (get_seqid(header).encode('utf-8'), seq))
+        size += len(seq)
+        if fo is not None and size >= BUFFER_SIZE:
+            fo.write(b"".join(buf))
+            buf = []
+            size = 0
+
+    if fo is None:
+        return b"".join(buf)
+    fo.write(b"".join(buf))
 
-def fq2fa(files, minlen):
+
+def fq2fa(files, minlen, min_q=0):
     '''Convert fastq files to fasta files'''
 
+    sys.stdout.flush()
+    out = sys.stdout.buffer
+
     for file in files:
-        for seqid, seq, ignore, quality in read_fastq(file):
-            if len(seq) < minlen:
-                LOG.info("The length of the filter sequence %s is %s" % (seqid, len(seq)))
-                continue
-            print('>%s\n%s' % (seqid, seq))
+        LOG.info("Reading message from %r" % file)
+        fp = open_file(file)
+        convert_records(fp, out, minlen, min_q)
+        fp.close()
+    out.flush()
+
+    return 0
+
+
+def fq2fa_task(task):
+    '''Convert one file or byte range, return the fasta bytes or a temporary file
+
+    A gzip file is written to a temporary file in tmpdir, it is removed when
+    the conversion fails.
+    '''
+
+    file, start, end, minlen, min_q, tmpdir = task
+
+    if start is not None:
+        fp = RangeReader(file, start, end)
+        try:
+            return convert_records(fp, None, minlen, min_q)
+        finally:
+            fp.close()
+
+    fo = tempfile.NamedTemporaryFile(prefix="fq2fa.", suffix=".fa", dir=tmpdir, delete=False)
+    try:
+        fp = open_file(file)
+        try:
+            convert_records(fp, fo, minlen, min_q)
+        finally:
+            fp.close()
+        fo.close()
+    except BaseException:
+        fo.close()
+        os.remove(fo.name)
+        raise
+
+    return fo.name
+
+
+def remove_result(result):
+
+    if isinstance(result, bytes):
+        return
+    try:
+        os.remove(result)
+    except OSError:
+        pass
+
+
+def write_result(out, result):
+
+    if isinstance(result, bytes):
+        out.write(result)
+        return
+
+    try:
+        with open(result, 'rb') as fh:
+            shutil.copyfileobj(fh, out, BUFFER_SIZE)
+    finally:
+        os.remove(result)
+
+
+def fq2fa_parallel(files, minlen, threads, min_q=0, tmpdir=None):
+    '''Convert fastq files in worker processes, write the results in input order
+
+    Gzip files are converted as a whole by one worker into a temporary file in
+    tmpdir, uncompressed files are cut into record aligned byte ranges. When
+    a task fails, the temporary files of the other tasks are removed.
+    '''
+
+    tasks = []
+    for file in files:
+        if file.endswith(".gz"):
+            tasks.append((file, None, None, minlen, min_q, tmpdir))
+            continue
+        for start, end in split_ranges(file, RANGE_SIZE, fastq=True):
+            tasks.append((file, start, end, minlen, min_q, tmpdir))
+
+    sys.stdout.flush()
+    out = sys.stdout.buffer
+    pending = deque()
+
+    with ProcessPoolExecutor(max_workers=threads) as pool:
+        try:
+            for task in tasks:
+                if task[1] in (None, 0):
+                    LOG.info("Reading message from %r" % task[0])
+                pending.append(pool.submit(fq2fa_task, task))
+                if len(pending) >= threads*2:
+                    write_result(out, pending.popleft().result())
+            while pending:
+                write_result(out, pending.popleft().result())
+        except BaseException:
+            for future in pending:
+                if not future.cancel() and future.exception() is None:
+                    remove_result(future.result())
+            raise
+    out.flush()
 
     return 0
 
@@ -66,6 +173,12 @@ def add_hlep_args(parser):
         help='Input fastq file.')
     parser.add_argument('--minlen', metavar='INT', type=int, default=0,
         help='Set the minimum length of sequence filtering, default=0')
+    parser.add_argument('-q', '--min-mean-q', dest='min_mean_q', metavar='FLOAT', type=float, default=0,
+        help='Set the minimum mean read quality (Phred, from the mean error rate), default=0')
+    parser.add_argument('-t', '--threads', metavar='INT', type=int, default=1,
+        help='Number of worker processes, default=1')
+    parser.add_argument('--tmpdir', metavar='DIR', type=str, default='.',
+        help='Directory of the temporary files of gzip inputs with --threads, default=current directory')
     return parser
 
 
@@ -85,13 +198,18 @@ name:
 attention:
     fq2fa.py data.fastq >data.fasta
     fq2fa.py data.fastq --minlen 500 >data.fasta
+    fq2fa.py *.fastq.gz --threads 8 --tmpdir /scratch >data.fasta
+    fq2fa.py ont.fastq.gz --min-mean-q 10 >data.fasta
 version: %s
 contact:  %s <%s>\
         ''' % (__version__, ' '.join(__author__), __email__))
 
     args = add_hlep_args(parser).parse_args()
 
-    fq2fa(args.fastq, args.minlen)
+    if args.threads > 1:
+        fq2fa_parallel(args.fastq, args.minlen, args.threads, args.min_mean_q, args.tmpdir)
+    else:
+        fq2fa(args.fastq, args.minlen, args.min_mean_q)
 
 
 if __name__ == "__main__":
@@ -1,12 +1,14 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import io
 import os
 import sys
 import logging
 import argparse
 
 from Bio import SeqIO
+from seqio import open_file
 
 LOG = logging.getLogger(__name__)
 
@@ -25,7 +27,7 @@ def gb2pep(file):
     LOG.info("reading message from %r" % file)
 
     if file.endswith(".gz"):
-        fh = gzip.open(file)
+        fh = io.TextIOWrapper(open_file(file), encoding='utf-8')
     else:
         fh = open(file)
 
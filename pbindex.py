@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import struct
+import logging
+import operator
+
+from array import array
+from collections import OrderedDict
+from seqio import GzipReader
+
+LOG = logging.getLogger(__name__)
+
+__version__ = "1.0.0"
+__author__ = ("Xingguo Zhang",)
+__email__ = "113178210@qq.com"
+__all__ = ["get_pbi", "read_pbi", "pbi_lengths", "PBI_COLUMNS"]
+
+
+PBI_MAGIC = b"PBI\x01"
+PBI_HEADER = struct.Struct("<4sIHI18s")
+# BasicData section of the PacBio BAM index, one array per column in file order
+PBI_COLUMNS = OrderedDict([
+    ("rgId", 'i'),
+    ("qStart", 'i'),
+    ("qEnd", 'i'),
+    ("holeNumber", 'i'),
+    ("readQual", 'f'),
+    ("ctxtFlag", 'B'),
+    ("fileOffset", 'q'),
+])
+SKIP_SIZE = 4*1024*1024
+
+
+def get_pbi(file):
+    '''Return the .pbi of a bam file, None when it is missing or older than the bam'''
+
+    pbi = "%s.pbi" % file
+
+    if not file.endswith(".bam") or not os.path.exists(pbi):
+        return None
+    if os.path.getmtime(pbi) < os.path.getmtime(file):
+        LOG.warning("Ignore %r, it is older than %r" % (pbi, file))
+        return None
+
+    return pbi
+
+
+def read_exact(fp, size, file):
+
+    data = []
+    while size > 0:
+        block = fp.read(size)
+        if not block:
+            raise Exception("%r is a truncated pbi file" % file)
+        data.append(block)
+        size -= len(block)
+
+    return b"".join(data)
+
+
+def read_pbi(file, columns=("qStart", "qEnd"), threads=1):
+    '''Read the header and the wanted BasicData columns of a PacBio .pbi
+
+    The index is BGZF compressed little endian, the columns that are not
+    wanted are inflated and dropped. Return (header, {column: array}).
+    '''
+
+    fp = GzipReader(file, threads)
+    magic, version, flags, number, reserved = PBI_HEADER.unpack(read_exact(fp, PBI_HEADER.size, file))
+
+    if magic != PBI_MAGIC:
+        fp.close()
+        raise Exception("%r is not a PacBio bam index" % file)
+    header = {"version": "%s.%s.%s" % (version >> 16, (version >> 8) & 0xff, version & 0xff),
+        "flags": flags, "reads": number}
+    data = {}
+
+    for column, code in PBI_COLUMNS.items():
+        size = array(code).itemsize*number
+        if column not in columns:
+            while size > 0:
+                size -= len(read_exact(fp, min(size, SKIP_SIZE), file))
+            continue
+        values = array(code)
+        values.frombytes(read_exact(fp, size, file))
+        if sys.byteorder != "little":
+            values.byteswap()
+        data[column] = values
+    fp.close()
+
+    return header, data
+
+
+def pbi_lengths(file, threads=1):
+    '''Return the read lengths (qEnd - qStart) stored in a .pbi as an unsigned int array'''
+
+    header, data = read_pbi(file, ("qStart", "qEnd"), threads)
+
+    try:
+        lengths = array('I', map(operator.sub, data["qEnd"], data["qStart"]))
+    except OverflowError:
+        raise Exception("%r has negative read lengths, the query start and end are not usable" % file)
+    LOG.info("Read %s lengths from %r (pbi version %s)" % (header["reads"], file, header["version"]))
+
+    return lengths
@@ -4,13 +4,16 @@
 import re
 import os
 import sys
-import gzip
 import logging
 import argparse
 import matplotlib
 matplotlib.use('Agg')
 
 from matplotlib import pyplot as plt
+from seqio import read_fasta, read_fastq
+from readstat import read_bam_lengths, cached_counts, nx_lengths, bin_counts, write_hist, \
+    is_hist, HIST_SUFFIX
+from statcache import open_cache
 
 
 LOG = logging.getLogger(__name__)
@@ -21,120 +24,38 @@ __email__ = "113178210@qq.com"
 __all__ = []
 
 
-def read_fasta(file):
-    '''Read fasta file'''
-
-    if file.endswith(".gz"):
-        fp = gzip.open(file)
-    elif file.endswith(".fasta") or file.endswith(".fa"):
-        fp = open(file)
-    else:
-        raise Exception("%r file format error" % file)
-
-    seq = ''
-
-    for line in fp:
-        if type(line) == type(b''):
-            line = line.decode('utf-8')
-        line = line.strip()
-
-        if not line:
-            continue
-        if not seq:
-            seq += "%s\n" % line.strip(">").split()[0]
-            continue
-        if line.startswith(">"):
-            line = line.strip(">").split()[0]
-            seq = seq.split('\n')
-
-            yield seq[0], seq[1]
-            seq = ''
-            seq += "%s\n" % line
-        else:
-            seq += line
-
-    seq = seq.split('\n')
-    if len(seq)==2:
-        yield seq[0], seq[1]
-    fp.close()
-
-
-def read_fastq(file):
-    '''Read fastq file'''
-
-    if file.endswith(".gz"):
-        fp = gzip.open(file)
-    elif file.endswith(".fastq") or file.endswith(".fq"):
-        fp = open(file)
-    else:
-        raise Exception("%r file format error" % file)
-
-    seq = ''
-
-    for line in fp:
-        if type(line) == type(b''):
-            line = line.decode('utf-8')
-        line = line.strip()
-
-        if not line:
-            continue
-        if not seq:
-            seq += "%s\n" % line.strip("@").split()[0]
-            continue
-        if line.startswith('@'):
-            line = line.strip("@").split()[0]
-            seq = seq.split('\n')
-
-            yield seq[0], seq[1]
-            seq = ''
-            seq = "%s\n" % line
-        else:
-            seq += "%s\n" % line
-
-    if len(seq.split('\n'))==5:
-        seq = seq.split('\n')
-        yield seq[0], seq[1]
-
-    fp.close()
-
-
-def stat_length(file):
-
-    length = []
+def stat_length(file, threads=1):
+    '''Yield the read lengths of a file, they are counted into a histogram as they are read'''
 
     if file.endswith(".fastq") or file.endswith(".fq") or file.endswith(".fastq.gz") or file.endswith(".fq.gz"):
         fh = read_fastq(file)
     elif file.endswith(".fasta") or file.endswith(".fa") or file.endswith(".fasta.gz") or file.endswith(".fa.gz"):
         fh = read_fasta(file)
+    elif file.endswith(".bam") or file.endswith(".sam"):
+        fh = None
     else:
         raise Exception("%r file format error" % file)
 
-    for seq_id,seq in fh:
-        length.append(len(seq))
-
-    return length
-
+    if fh is None:
+        for length in read_bam_lengths(file, threads):
+            yield length
+        return
 
-def n50(lengths):
-
-    sum_length = sum(lengths)
-    accu_length = 0
-    n = 0
-
-    for i in sorted(lengths, reverse=True):
-        accu_length += i
-        if accu_length >= sum_length*0.5:
-            n = i 
-            break 
-
-    return n
+    for seq_id,seq in fh:
+        yield len(seq)
 
 
-def plot_read_length(file, out, xmin=0, bins=50):
+def plot_read_length(file, out, xmin=0, bins=50, threads=1, cache=None, hist=False,
+                     dpi=700, vector=False):
 
-    length = stat_length(file)
-    n50len = n50(length)
+    counts = cached_counts(file, cache, stat_length, threads)
+    if hist and not is_hist(file):
+        write_hist("%s%s" % (out, HIST_SUFFIX), counts)
+    n50len = nx_lengths(counts, sum(i*counts[i] for i in counts), [50])[50]
     xmax = n50len*2.5
+    if xmax <= xmin:
+        xmax = xmin+bins
+    edges, values = bin_counts(counts, bins, xmin, xmax)
 
     plt.style.use('ggplot')
     fig, ax = plt.subplots(figsize=(10, 6),)
@@ -145,7 +66,10 @@ def plot_read_length(file, out, xmin=0, bins=50):
     ax.spines['left'].set_visible(False) #去掉左边框
     ax.spines['right'].set_visible(False) #去掉右边框
 
-    ax.hist(length, bins=bins, range=(xmin, xmax), histtype='stepfilled', color="#cb416b", alpha=0.75)
+    if hasattr(ax, "stairs"):
+        ax.stairs(values, edges, fill=True, color="#cb416b", alpha=0.75)
+    else:
+        ax.bar(edges[:-1], values, width=edges[1]-edges[0], align='edge', color="#cb416b", alpha=0.75)
     ax.set_xlim(xmin, xmax)
 
     font = {'weight': 'bold','size': 12,}
@@ -153,7 +77,8 @@ def plot_read_length(file, out, xmin=0, bins=50):
     ax.set_xlabel('Length', font)
     plt.xticks()
     plt.savefig("%s.reads_length.pdf" % out)
-    plt.savefig("%s.reads_length.png" % out, dpi=700) 
+    if not vector:
+        plt.savefig("%s.reads_length.png" % out, dpi=dpi)
 
 
 def add_hlep(parser):
@@ -164,6 +89,18 @@ def add_hlep(parser):
         help="Bins to stat (default: 100).")
     parser.add_argument("--xmin", metavar="INT", type=int, default=0,
         help="Show the minimum read length (default: 0).")
+    parser.add_argument('-t', '--threads', metavar='INT', type=int, default=1,
+        help='Decompression threads for bam input (default: 1).')
+    parser.add_argument('--dpi', metavar='INT', type=int, default=700,
+        help='Resolution of the png (default: 700).')
+    parser.add_argument('--vector', action='store_true',
+        help='Only write the pdf, skip the png.')
+    parser.add_argument('--hist', action='store_true',
+        help='Write the read length histogram to out.lenhist.')
+    parser.add_argument('--no-cache', dest='no_cache', action='store_true',
+        help='Do not read or write the statistics cache.')
+    parser.add_argument('--refresh', action='store_true',
+        help='Recount the input and replace its cache entry.')
     parser.add_argument('-o', '--out', metavar='STR',type=str, default="out",
         help='Out name')
 
@@ -180,14 +117,22 @@ def main():
     parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
     description='''
 name:
-    plot_read_length.py  Drawing the read length map via fastq or fasta files
+    plot_read_length.py  Drawing the read length map via fastq, fasta or bam files
 
 attention:
     plot_read_length.py reads.fa
     plot_read_length.py reads.fq
+    plot_read_length.py subreads.bam
+    plot_read_length.py subreads.lenhist --vector
+
+    The lengths of a bam are read from its PacBio index (subreads.bam.pbi) when it exists.
+    The length histogram is cached (~/.cache/stat_reads, or STAT_CACHE_DIR) and reused
+    while the file is unchanged.
 ''')
     args = add_hlep(parser).parse_args()
-    plot_read_length(args.input, args.out, args.xmin, args.bins)
+    cache = open_cache(args.no_cache, args.refresh)
+    plot_read_length(args.input, args.out, args.xmin, args.bins, args.threads, cache, args.hist,
+        args.dpi, args.vector)
 
 
 if __name__ == "__main__":
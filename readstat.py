@@ -0,0 +1,382 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sys
+import math
+import zlib
+import struct
+import logging
+
+from array import array
+from itertools import islice
+from collections import Counter
+from pbindex import get_pbi, pbi_lengths
+
+LOG = logging.getLogger(__name__)
+
+__version__ = "1.0.0"
+__author__ = ("Xingguo Zhang",)
+__email__ = "113178210@qq.com"
+__all__ = ["new_lengths", "read_bam_lengths", "length_counts", "cached_counts", "store_counts", "nx_lengths",
+           "stat_counts", "stat_lengths", "write_hist", "read_hist", "is_hist", "bin_counts", "LengthStat", "LengthSketch", "new_stat", "NX_LEVELS", "HIST_SUFFIX"]
+
+
+NX_LEVELS = (10, 20, 30, 40, 50, 60, 70, 80, 90)
+HIST_SUFFIX = ".lenhist"
+HIST_MAGIC = b"RLH\x01"
+HIST_VERSION = 1
+# magic, version, reads, bases, distinct lengths, compressed body size
+HIST_HEADER = struct.Struct("<4sHQQQQ")
+SKETCH_BATCH = 1024*1024
+
+
+def new_lengths():
+    '''Return an empty unsigned int array for read lengths (4 bytes per read)'''
+
+    return array('I')
+
+
+def read_bam_lengths(file, threads=1):
+    '''Return the read lengths of a bam or sam file
+
+    The lengths come from the PacBio .pbi when there is a current one, otherwise
+    from query_length, the sequences are never decoded.
+    '''
+
+    pbi = get_pbi(file)
+    if pbi:
+        return pbi_lengths(pbi, threads)
+
+    import pysam
+
+    if file.endswith(".bam"):
+        fh = pysam.AlignmentFile(file, "rb", check_sq=False, threads=threads)
+    elif file.endswith(".sam"):
+        fh = pysam.AlignmentFile(file, 'r', threads=threads)
+    else:
+        raise Exception("%r file format error" % file)
+
+    lengths = new_lengths()
+    lengths.extend(line.query_length for line in fh)
+    fh.close()
+
+    return lengths
+
+
+def length_counts(lengths):
+    '''Count the reads of every distinct length'''
+
+    return Counter(lengths)
+
+
+def nx_lengths(counts, total, levels=NX_LEVELS):
+    '''Return the Nx lengths of a {length: count} histogram
+
+    Only the distinct lengths are sorted, so the cost does not grow with the
+    number of reads. The Nx length is the first length, longest first, at
+    which the accumulated bases reach x% of the total.
+    '''
+
+    levels = sorted(levels)
+    result = {}
+    accu = 0
+    i = 0
+
+    for length in sorted(counts, reverse=True):
+        accu += length*counts[length]
+        while i < len(levels) and accu >= total*levels[i]/100.0:
+            result[levels[i]] = length
+            i += 1
+        if i == len(levels):
+            break
+
+    for level in levels[i:]:
+        result[level] = 0
+
+    return result
+
+
+def counts_to_arrays(counts):
+    '''Return the sorted lengths and their read counts of a histogram as two arrays'''
+
+    keys = sorted(counts)
+
+    return [array('I', keys), array('Q', (counts[i] for i in keys))]
+
+
+def arrays_to_counts(values):
+
+    return Counter(dict(zip(values[0], values[1])))
+
+
+def store_counts(cache, file, counts):
+    '''Store the length histogram of a file in the cache'''
+
+    if cache is not None:
+        cache.save(file, "hist", counts_to_arrays(counts))
+
+
+def is_hist(file):
+
+    return file.endswith(HIST_SUFFIX)
+
+
+def write_hist(file, counts):
+    '''Write a length histogram as a .lenhist file
+
+    The file is a little endian header with the exact read and base totals,
+    followed by the zlib compressed distinct lengths (delta coded uint32) and
+    their read counts (uint64). It is exact, a few KB for a sequencing cell.
+    '''
+
+    lengths, numbers = counts_to_arrays(counts)
+    delta = array('I', lengths)
+    for i in range(len(delta)-1, 0, -1):
+        delta[i] -= delta[i-1]
+    if sys.byteorder != "little":
+        delta.byteswap()
+        numbers.byteswap()
+
+    body = zlib.compress(delta.tobytes() + numbers.tobytes(), 6)
+    bases = sum(i*counts[i] for i in counts)
+    with open(file, 'wb') as fo:
+        fo.write(HIST_HEADER.pack(HIST_MAGIC, HIST_VERSION, sum(numbers), bases, len(lengths), len(body)))
+        fo.write(body)
+
+    return file
+
+
+def read_hist(file):
+    '''Read a .lenhist file written by write_hist, return the length histogram'''
+
+    with open(file, 'rb') as fp:
+        data = fp.read()
+    magic, version, reads, bases, number, size = HIST_HEADER.unpack_from(data)
+
+    if magic != HIST_MAGIC:
+        raise Exception("%r is not a read length histogram" % file)
+    if version > HIST_VERSION:
+        raise Exception("%r is histogram version %s, this script reads up to %s" % (file, version, HIST_VERSION))
+
+    body = zlib.decompress(data[HIST_HEADER.size:HIST_HEADER.size+size])
+    lengths = array('I')
+    numbers = array('Q')
+    lengths.frombytes(body[:lengths.itemsize*number])
+    numbers.frombytes(body[lengths.itemsize*number:])
+    if sys.byteorder != "little":
+        lengths.byteswap()
+        numbers.byteswap()
+    for i in range(1, len(lengths)):
+        lengths[i] += lengths[i-1]
+
+    counts = arrays_to_counts([lengths, numbers])
+    if len(numbers) != number or sum(numbers) != reads:
+        raise Exception("%r is a broken read length histogram" % file)
+
+    return counts
+
+
+def cached_counts(file, cache, reader, *args):
+    '''Return the length histogram of a file
+
+    A .lenhist file is read directly. Otherwise the histogram is loaded from
+    the cache when there is an entry for the current file, or the lengths are
+    read by reader(file, *args) and the histogram is stored. cache is a
+    StatCache or None.
+    '''
+
+    if is_hist(file):
+        return read_hist(file)
+
+    if cache is not None:
+        values = cache.load(file, "hist")
+        if values:
+            return arrays_to_counts(values)
+
+    counts = length_counts(reader(file, *args))
+    store_counts(cache, file, counts)
+
+    return counts
+
+
+def stat_counts(counts, levels=NX_LEVELS):
+    '''Return bases, number, mean, max and the Nx lengths of a length histogram'''
+
+    bases = 0
+    number = 0
+
+    for length, count in counts.items():
+        bases += length*count
+        number += count
+
+    if number:
+        mean = bases/number
+    else:
+        mean = 0
+    longest = max(counts) if counts else 0
+
+    return bases, number, mean, longest, nx_lengths(counts, bases, levels)
+
+
+def bin_counts(counts, bins, xmin, xmax):
+    '''Return the edges and read counts of equal width bins over [xmin, xmax]
+
+    Like numpy.histogram with a range, lengths outside the range are left out
+    and xmax falls in the last bin. The cost depends on the distinct lengths only.
+    '''
+
+    width = (xmax-xmin)*1.0/bins
+    edges = [xmin+i*width for i in range(bins)] + [xmax]
+    values = [0]*bins
+
+    for length, count in counts.items():
+        if length < xmin or length > xmax:
+            continue
+        values[min(int((length-xmin)/width), bins-1)] += count
+
+    return edges, values
+
+
+def stat_lengths(lengths, levels=NX_LEVELS):
+    '''Return bases, number, mean, max and the Nx lengths of the reads in one pass'''
+
+    return stat_counts(length_counts(lengths), levels)
+
+
+class LengthStat(object):
+    '''Streaming read length statistics kept as a length histogram
+
+    Reads are added one at a time or in batches as they are read, the memory
+    depends on the number of distinct lengths only. The statistics of
+    several files are merged with update.
+    '''
+
+    def __init__(self, counts=None):
+
+        self.counts = Counter() if counts is None else counts
+
+    def add(self, length):
+
+        self.counts[length] += 1
+
+    def extend(self, lengths):
+
+        self.counts.update(lengths)
+
+    def update(self, other):
+
+        self.counts.update(other.counts)
+
+    def stat(self, levels=NX_LEVELS):
+        '''Return bases, number, mean, max and the Nx lengths'''
+
+        return stat_counts(self.counts, levels)
+
+
+class LengthSketch(object):
+    '''Mergeable approximate read length statistics with a relative error
+
+    Lengths are counted in logarithmic buckets (as in DDSketch): bucket i
+    holds the lengths in (gamma^(i-1), gamma^i] with gamma = (1+alpha)/(1-alpha),
+    and reports them as one length within alpha (relative) of all of them.
+    A few hundred buckets cover any read length, sketches filled in separate
+    processes are merged by adding the buckets. Bases, number and the longest
+    read are kept exactly, the Nx lengths are within alpha.
+    '''
+
+    def __init__(self, alpha=0.01):
+
+        if not 0 < alpha < 1:
+            raise Exception("The sketch error %r must be between 0 and 1" % alpha)
+        self.alpha = alpha
+        self.gamma = (1+alpha)/(1-alpha)
+        self.log_gamma = math.log(self.gamma)
+        self.buckets = Counter()
+        self.bases = Counter()
+        self.longest = 0
+
+    def index(self, length):
+
+        if length <= 0:
+            return None
+        return int(math.ceil(math.log(length)/self.log_gamma - 1e-9))
+
+    def value(self, index):
+
+        if index is None:
+            return 0
+        return int(round(2*self.gamma**index/(self.gamma+1)))
+
+    def add_counts(self, counts):
+        '''Add a {length: count} histogram'''
+
+        for length, count in counts.items():
+            index = self.index(length)
+            self.buckets[index] += count
+            self.bases[index] += length*count
+            if length > self.longest:
+                self.longest = length
+
+    def add(self, length):
+
+        self.add_counts({length: 1})
+
+    def extend(self, lengths):
+
+        lengths = iter(lengths)
+        while True:
+            counts = Counter(islice(lengths, SKETCH_BATCH))
+            if not counts:
+                break
+            self.add_counts(counts)
+
+    def update(self, other):
+        '''Merge a LengthSketch with the same alpha, or a LengthStat'''
+
+        if not isinstance(other, LengthSketch):
+            return self.add_counts(other.counts)
+        if other.alpha != self.alpha:
+            raise Exception("Can not merge sketches with errors %r and %r" % (self.alpha, other.alpha))
+        self.buckets.update(other.buckets)
+        self.bases.update(other.bases)
+        self.longest = max(self.longest, other.longest)
+
+    @property
+    def counts(self):
+        '''The approximate length histogram, one length per bucket'''
+
+        return Counter(dict((self.value(i), n) for i, n in self.buckets.items()))
+
+    def stat(self, levels=NX_LEVELS):
+        '''Return bases, number, mean, max and the Nx lengths'''
+
+        bases = sum(self.bases.values())
+        number = sum(self.buckets.values())
+        levels = sorted(levels)
+        nx = {}
+        accu = 0
+        i = 0
+
+        for index in sorted(self.buckets, key=lambda x: -1 if x is None else x, reverse=True):
+            accu += self.bases[index]
+            while i < len(levels) and accu >= bases*levels[i]/100.0:
+                nx[levels[i]] = min(self.value(index), self.longest)
+                i += 1
+        for level in levels[i:]:
+            nx[level] = 0
+
+        if number:
+            mean = bases/number
+        else:
+            mean = 0
+
+        return bases, number, mean, self.longest, nx
+
+
+def new_stat(alpha=0):
+    '''Return an exact LengthStat, or a LengthSketch when alpha > 0'''
+
+    if alpha > 0:
+        return LengthSketch(alpha)
+
+    return LengthStat()
@@ -0,0 +1,997 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import math
+import zlib
+import struct
+import logging
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+LOG = logging.getLogger(__name__)
+
+__version__ = "1.0.0"
+__author__ = ("Xingguo Zhang",)
+__email__ = "113178210@qq.com"
+__all__ = ["open_file", "GzipReader", "iter_fasta", "stream_fasta", "iter_fastq",
+           "read_fasta", "read_fastq", "read_seq", "is_fastq", "is_fasta", "build_fai", "read_fai", "get_fai",
+           "fetch_fai", "RangeReader", "find_record_start", "split_ranges",
+           "scan_records", "FastaWriter", "GzipWriter",
+           "copy_range", "mean_qualities", "iter_mean_quality"]
+
+
+CHUNK_SIZE = 1024*1024
+FASTA_SUFFIX = (".fasta", ".fa", ".fasta.gz", ".fa.gz")
+FASTQ_SUFFIX = (".fastq", ".fq", ".fastq.gz", ".fq.gz")
+SPACE = b"\r\n\t "
+LINE_CHARS = (b"\n", b"\r")
+GZIP_THREADS = 4
+GZIP_QUEUE = 8
+GZIP_BLOCK = 256*1024
+GZIP_WRITE_BLOCK = 4*1024*1024
+BGZF_BATCH = 64
+BGZF_BLOCK = 0xff00
+QUALITY_BATCH = 4*1024*1024
+BGZF_EOF = b"\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00\x42\x43\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00"
+
+
+def is_fasta(file):
+
+    return file.endswith(FASTA_SUFFIX)
+
+
+def is_fastq(file):
+
+    return file.endswith(FASTQ_SUFFIX)
+
+
+def is_bgzf(file):
+
+    with open(file, 'rb') as fp:
+        header = fp.read(18)
+
+    return header[:4] == b"\x1f\x8b\x08\x04" and header[12:14] == b"BC"
+
+
+def read_bgzf_block(fp):
+    '''Read one raw BGZF block, return (deflate data, uncompressed size)
+
+    NUL padding between or after the blocks is skipped, as gzip does.
+    '''
+
+    header = fp.read(12)
+    while header[:1] == b"\0":
+        header = header.lstrip(b"\0")
+        header += fp.read(12-len(header))
+    if not header:
+        return None, 0
+    if len(header) < 12 or header[:4] != b"\x1f\x8b\x08\x04":
+        raise Exception("Invalid BGZF block header")
+
+    xlen = struct.unpack("<H", header[10:12])[0]
+    extra = fp.read(xlen)
+    bsize = 0
+    n = 0
+    while n < xlen:
+        slen = struct.unpack("<H", extra[n+2:n+4])[0]
+        if extra[n:n+2] == b"BC":
+            bsize = struct.unpack("<H", extra[n+4:n+6])[0] + 1
+        n += 4 + slen
+    if not bsize:
+        raise Exception("BGZF block without BC subfield")
+
+    data = fp.read(bsize - 12 - xlen)
+    if len(data) != bsize - 12 - xlen:
+        raise Exception("Truncated BGZF block")
+
+    return data[:-8], struct.unpack("<I", data[-4:])[0]
+
+
+def inflate_blocks(blocks):
+
+    return b"".join(zlib.decompress(data, -15) for data in blocks)
+
+
+class GzipReader(object):
+    '''Read a gzip file that is decompressed on background threads
+
+    A reader thread inflates the file and hands the blocks over through a
+    bounded queue, zlib releases the GIL so decompression overlaps with the
+    parsing in the main thread. BGZF files are cut into their blocks and
+    inflated by a pool of threads, the block order is kept by queueing the
+    futures.
+    '''
+
+    def __init__(self, file, threads=GZIP_THREADS, queue_size=GZIP_QUEUE):
+
+        self.name = file
+        self.fp = open(file, 'rb')
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.stop = threading.Event()
+        self.buffer = b""
+        self.offset = 0
+        self.eof = False
+        self.pool = None
+
+        if threads > 1 and is_bgzf(file):
+            self.pool = ThreadPoolExecutor(max_workers=threads)
+            target = self._read_bgzf
+        else:
+            target = self._read_gzip
+
+        self.thread = threading.Thread(target=self._run, args=(target,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _put(self, item):
+
+        while not self.stop.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _run(self, target):
+
+        try:
+            target()
+        except Exception as error:
+            self._put(error)
+            return
+        self._put(None)
+
+    def _read_gzip(self):
+
+        inflater = zlib.decompressobj(31)
+        member = False
+
+        while True:
+            data = self.fp.read(GZIP_BLOCK)
+            if not data:
+                break
+            while data:
+                if not member:
+                    data = data.lstrip(b"\0")
+                    if not data:
+                        break
+                block = inflater.decompress(data, GZIP_BLOCK*16)
+                member = True
+                if block and not self._put(block):
+                    return
+                if inflater.eof:
+                    data = inflater.unused_data
+                    inflater = zlib.decompressobj(31)
+                    member = False
+                else:
+                    data = inflater.unconsumed_tail
+
+        if member:
+            raise Exception("%r is a truncated gzip file" % self.name)
+
+    def _read_bgzf(self):
+
+        blocks = []
+
+        while True:
+            data, size = read_bgzf_block(self.fp)
+            if data is not None and size:
+                blocks.append(data)
+            if blocks and (data is None or len(blocks) >= BGZF_BATCH):
+                if not self._put(self.pool.submit(inflate_blocks, blocks)):
+                    return
+                blocks = []
+            if data is None:
+                break
+
+    def _next_block(self):
+
+        while True:
+            block = self.queue.get()
+            if block is None:
+                self.eof = True
+                return b""
+            if isinstance(block, Exception):
+                self.eof = True
+                raise block
+            if not isinstance(block, bytes):
+                block = block.result()
+            if block:
+                return block
+
+    def read(self, size=-1):
+
+        if size is None or size < 0:
+            blocks = [self.buffer[self.offset:]]
+            while not self.eof:
+                blocks.append(self._next_block())
+            self.buffer = b""
+            self.offset = 0
+            return b"".join(blocks)
+
+        if self.offset >= len(self.buffer):
+            if self.eof:
+                return b""
+            self.buffer = self._next_block()
+            self.offset = 0
+
+        data = self.buffer[self.offset:self.offset+size]
+        self.offset += len(data)
+        if self.offset >= len(self.buffer):
+            self.buffer = b""
+            self.offset = 0
+
+        return data
+
+    def readable(self):
+
+        return True
+
+    def writable(self):
+
+        return False
+
+    def seekable(self):
+
+        return False
+
+    @property
+    def closed(self):
+
+        return self.fp.closed
+
+    def read1(self, size=-1):
+
+        return self.read(size)
+
+    def flush(self):
+
+        pass
+
+    def close(self):
+
+        self.stop.set()
+        self.thread.join()
+        if self.pool is not None:
+            self.pool.shutdown(wait=True)
+        self.fp.close()
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, *args):
+
+        self.close()
+
+
+def open_file(file, threads=GZIP_THREADS):
+    '''Open a plain or gzip compressed file in binary mode'''
+
+    if file.endswith(".gz"):
+        return GzipReader(file, threads)
+
+    return open(file, 'rb')
+
+
+def read_chunks(fp, chunk_size=CHUNK_SIZE):
+
+    while True:
+        chunk = fp.read(chunk_size)
+        if not chunk:
+            break
+        yield chunk
+
+
+def split_fasta_record(record):
+    '''Split a raw record (without '>') into the header and the joined sequence'''
+
+    if b"\n#" in record:
+        record = b"\n".join(i for i in record.split(b"\n") if not i.startswith(b"#"))
+    header, sep, seq = record.partition(b"\n")
+
+    return header.rstrip(), seq.translate(None, SPACE)
+
+
+def iter_fasta(fp, chunk_size=CHUNK_SIZE):
+    '''Yield (header, seq) as bytes for every record of an opened fasta file
+
+    The file is read in large chunks which are cut into records with one
+    bytes.split on "\\n>", the line breaks of a sequence are removed with one
+    bytes.translate call.
+    '''
+
+    pieces = [b"\n"]
+    started = False
+
+    for chunk in read_chunks(fp, chunk_size):
+        if not started:
+            chunk = pieces.pop() + chunk
+            start = chunk.find(b"\n>")
+            if start < 0:
+                pieces.append(chunk[-1:])
+                continue
+            chunk = chunk[start+2:]
+            started = True
+        elif chunk.startswith(b">") and pieces[-1].endswith(b"\n"):
+            yield split_fasta_record(b"".join(pieces))
+            pieces = []
+            chunk = chunk[1:]
+
+        records = chunk.split(b"\n>")
+        if len(records) == 1:
+            pieces.append(chunk)
+            continue
+        pieces.append(records[0])
+        yield split_fasta_record(b"".join(pieces))
+        for record in records[1:-1]:
+            yield split_fasta_record(record)
+        pieces = [records[-1]]
+
+    if started:
+        yield split_fasta_record(b"".join(pieces))
+
+
+def stream_fasta(fp, chunk_size=CHUNK_SIZE):
+    '''Yield (header, b"") when a fasta record starts and (None, bases) for the
+    pieces of its sequence, so no record has to be held in memory'''
+
+    header = None
+    started = False
+    at_start = True
+
+    for chunk in read_chunks(fp, chunk_size):
+        pos = 0
+        size = len(chunk)
+
+        while pos < size:
+            if header is not None:
+                end = chunk.find(b"\n", pos)
+                if end < 0:
+                    header.append(chunk[pos:])
+                    break
+                header.append(chunk[pos:end])
+                yield b"".join(header).rstrip(), b""
+                header = None
+                started = True
+                pos = end + 1
+                at_start = True
+                continue
+
+            if at_start and chunk.startswith(b">", pos):
+                end = pos
+            else:
+                end = chunk.find(b"\n>", pos)
+                end = size if end < 0 else end + 1
+            if started and end > pos:
+                data = chunk[pos:end].translate(None, SPACE)
+                if data:
+                    yield None, data
+            if end < size:
+                header = []
+                pos = end + 1
+            else:
+                pos = size
+            at_start = False
+
+        at_start = chunk.endswith(b"\n")
+
+    if header is not None:
+        yield b"".join(header).rstrip(), b""
+
+
+def iter_fastq(fp, chunk_size=CHUNK_SIZE):
+    '''Yield (header, seq, plus, quality) as bytes for every fastq record
+
+    Every chunk is split into lines at once and grouped by four, blank lines
+    are ignored. Only the unfinished last line of a chunk is joined to the
+    next one, the chunks themselves are not copied.
+    '''
+
+    rest = []
+    lines = []
+
+    for chunk in read_chunks(fp, chunk_size):
+        if b"\r" in chunk:
+            chunk = chunk.replace(b"\r", b"")
+
+        new = chunk.split(b"\n")
+        if len(new) == 1:
+            rest.append(chunk)
+            continue
+        if rest:
+            rest.append(new[0])
+            new[0] = b"".join(rest)
+        rest = [new.pop()]
+        if b"" in new:
+            new = [i for i in new if i]
+        lines += new
+
+        n = len(lines) - len(lines) % 4
+        for record in _group_fastq(lines, n):
+            yield record
+        lines = lines[n:]
+
+    rest = b"".join(rest).strip()
+    if rest:
+        lines.append(rest)
+    if len(lines) % 4:
+        raise Exception("Fastq file ended with an incomplete record: %r" % lines[0][:50])
+    for record in _group_fastq(lines, len(lines)):
+        yield record
+
+
+def _group_fastq(lines, n):
+
+    it = iter(lines[:n])
+
+    for record in zip(it, it, it, it):
+        if not record[0].startswith(b"@"):
+            raise Exception("Fastq record does not start with '@': %r" % record[0][:50])
+        yield record
+
+
+def get_seqid(header):
+
+    header = header.lstrip(b">@").split(None, 1)
+
+    if not header:
+        return ""
+    return header[0].decode('utf-8')
+
+
+def error_table(offset=33):
+    '''Return the error probability of every quality character'''
+
+    return [10**(-(i-offset)/10.0) for i in range(256)]
+
+
+def _mean_qualities_numpy(numpy, quals, offset):
+
+    lengths = numpy.fromiter((len(i) for i in quals), dtype=numpy.int64, count=len(quals))
+    table = numpy.array(error_table(offset))
+    errors = table[numpy.frombuffer(b"".join(quals), dtype=numpy.uint8)]
+    sums = numpy.concatenate(([0.0], numpy.cumsum(errors)))
+    ends = numpy.cumsum(lengths)
+
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        mean = -10*numpy.log10((sums[ends]-sums[ends-lengths])/lengths)
+    mean[lengths == 0] = 0
+
+    return mean.tolist()
+
+
+def mean_qualities(quals, offset=33):
+    '''Return the mean Phred quality of each quality string (bytes)
+
+    The mean is taken over the error probabilities, -10*log10(mean(10^(-q/10))),
+    as reported for nanopore reads. With numpy the whole batch is decoded with
+    frombuffer and a lookup table and averaged at once, without numpy every
+    distinct character of a read is counted.
+    '''
+
+    try:
+        import numpy
+    except ImportError:
+        numpy = None
+
+    if numpy is not None and quals:
+        return _mean_qualities_numpy(numpy, quals, offset)
+
+    table = error_table(offset)
+    result = []
+    for qual in quals:
+        if not qual:
+            result.append(0.0)
+            continue
+        error = sum(table[i]*qual.count(i) for i in set(qual))
+        result.append(-10*math.log10(error/len(qual)))
+
+    return result
+
+
+def iter_mean_quality(records, index=3, offset=33, batch_size=QUALITY_BATCH):
+    '''Yield (record, mean quality) for fastq records, record[index] is the
+    quality as bytes or str, the qualities are decoded in batches'''
+
+    batch = []
+    quals = []
+    size = 0
+
+    for record in records:
+        qual = record[index]
+        if not isinstance(qual, bytes):
+            qual = qual.encode('ascii')
+        batch.append(record)
+        quals.append(qual)
+        size += len(qual)
+        if size >= batch_size:
+            for item in zip(batch, mean_qualities(quals, offset)):
+                yield item
+            batch = []
+            quals = []
+            size = 0
+
+    for item in zip(batch, mean_qualities(quals, offset)):
+        yield item
+
+
+def read_fasta(file):
+    '''Read fasta file'''
+
+    fp = open_file(file)
+
+    for header, seq in iter_fasta(fp):
+        yield get_seqid(header), seq.decode('utf-8')
+    fp.close()
+
+
+def read_fastq(file, full=False):
+    '''Read fastq file, yield [seqid, seq, '+', quality] when full is true'''
+
+    fp = open_file(file)
+
+    for header, seq, plus, quality in iter_fastq(fp):
+        if full:
+            yield [get_seqid(header), seq.decode('utf-8'), plus.decode('utf-8'), quality.decode('utf-8')]
+        else:
+            yield get_seqid(header), seq.decode('utf-8')
+    fp.close()
+
+
+def read_seq(file):
+    '''Read fasta or fastq file by its suffix, yield (seqid, seq)'''
+
+    if is_fastq(file):
+        return read_fastq(file)
+
+    return read_fasta(file)
+
+
+def scan_fasta(file):
+    '''Yield the samtools faidx entry [name, length, offset, linebases, linewidth]
+    of every record in an uncompressed fasta file'''
+
+    fp = open(file, 'rb')
+    offset = 0
+    entry = None
+    short = False
+
+    for line in fp:
+        width = len(line)
+        if line.startswith(b">"):
+            if entry:
+                yield entry
+            entry = [get_seqid(line), 0, offset+width, 0, 0]
+            short = False
+            offset += width
+            continue
+        offset += width
+        if entry is None:
+            continue
+
+        if line.startswith(b"#"):
+            fp.close()
+            raise Exception("Comment line in sequence %r of %r" % (entry[0], file))
+        bases = len(line.rstrip(b"\r\n"))
+        if short and bases:
+            fp.close()
+            raise Exception("Different line length in sequence %r of %r" % (entry[0], file))
+        if not entry[3]:
+            entry[3] = bases
+            entry[4] = width
+        elif bases != entry[3] or width != entry[4]:
+            if bases > entry[3]:
+                fp.close()
+                raise Exception("Different line length in sequence %r of %r" % (entry[0], file))
+            short = True
+        entry[1] += bases
+
+    if entry:
+        yield entry
+    fp.close()
+
+
+def scan_fastq(file):
+    '''Yield the samtools fqidx entry [name, length, offset, linebases, linewidth, qualoffset]
+    of every record in an uncompressed fastq file'''
+
+    fp = open(file, 'rb')
+    offset = 0
+    lines = []
+
+    for line in fp:
+        lines.append(line)
+        if len(lines) < 4:
+            continue
+        header, seq, plus, quality = lines
+        if not header.startswith(b"@") or not plus.startswith(b"+"):
+            fp.close()
+            raise Exception("%r is not a single line fastq file" % file)
+
+        bases = len(seq.rstrip(b"\r\n"))
+        start = offset + len(header)
+        yield [get_seqid(header), bases, start, bases, len(seq), start+len(seq)+len(plus)]
+        offset += len(header) + len(seq) + len(plus) + len(quality)
+        lines = []
+
+    fp.close()
+
+
+def build_fai(file, out=None):
+    '''Index an uncompressed fasta or fastq file, return the index as an OrderedDict'''
+
+    LOG.info("Building index of %r" % file)
+    scan = scan_fastq if is_fastq(file) else scan_fasta
+    index = OrderedDict((entry[0], entry) for entry in scan(file))
+
+    if out is None:
+        out = "%s.fai" % file
+    if out:
+        try:
+            with open(out, 'w') as fo:
+                for entry in index.values():
+                    fo.write("%s\n" % "\t".join(map(str, entry)))
+        except (IOError, OSError):
+            LOG.warning("Can not write index %r, keep it in memory" % out)
+
+    return index
+
+
+def read_fai(file):
+
+    index = OrderedDict()
+
+    for line in open(file):
+        line = line.rstrip("\r\n").split("\t")
+        if len(line) < 5:
+            continue
+        index[line[0]] = [line[0]] + [int(i) for i in line[1:]]
+
+    return index
+
+
+def get_fai(file):
+    '''Load the .fai of a file, build it when it is missing or older than the file'''
+
+    fai = "%s.fai" % file
+
+    if os.path.exists(fai) and os.path.getmtime(fai) >= os.path.getmtime(file):
+        return read_fai(fai)
+
+    return build_fai(file, fai)
+
+
+def fetch_fai(fp, entry, start, end, chunk_size=CHUNK_SIZE):
+    '''Yield the bases [start, end) (0-based) of an indexed record in chunks'''
+
+    length, offset, linebases, linewidth = entry[1:5]
+    start = max(start, 0)
+    end = min(end, length)
+
+    if start >= end:
+        return
+
+    pos = offset + start//linebases*linewidth + start%linebases
+    stop = offset + (end-1)//linebases*linewidth + (end-1)%linebases + 1
+    fp.seek(pos)
+
+    while pos < stop:
+        data = fp.read(min(chunk_size, stop-pos))
+        if not data:
+            raise Exception("Index does not match the file at %r" % entry[0])
+        pos += len(data)
+        yield data.translate(None, SPACE)
+
+
+class RangeReader(object):
+    '''Read the bytes [start, end) of a file'''
+
+    def __init__(self, file, start, end):
+
+        self.fp = open(file, 'rb')
+        self.fp.seek(start)
+        self.left = end - start
+
+    def read(self, size=-1):
+
+        if size is None or size < 0 or size > self.left:
+            size = self.left
+        data = self.fp.read(size)
+        self.left -= len(data)
+
+        return data
+
+    def close(self):
+
+        self.fp.close()
+
+
+def find_record_start(fp, offset, fastq=False, window=CHUNK_SIZE):
+    '''Return the offset of the first record that starts at or after offset'''
+
+    if offset <= 0:
+        return 0
+
+    while True:
+        fp.seek(offset - 1)
+        data = fp.read(window + 1)
+        lines = data.split(b"\n")
+        if len(data) < window + 1:
+            lines.append(b"")
+        pos = offset + len(lines[0])
+
+        for i in range(1, len(lines)-1):
+            line = lines[i]
+            if not fastq and line.startswith(b">"):
+                return pos
+            if fastq and line.startswith(b"@") and i+3 < len(lines) and lines[i+2].startswith(b"+"):
+                return pos
+            pos += len(line) + 1
+
+        if len(data) < window + 1:
+            return offset + len(data) - 1
+        window *= 2
+
+
+def split_ranges(file, size, fastq=False):
+    '''Split an uncompressed file into byte ranges of about size that start at records'''
+
+    total = os.path.getsize(file)
+    ranges = []
+
+    with open(file, 'rb') as fp:
+        start = 0
+        while start < total:
+            end = find_record_start(fp, start + size, fastq)
+            end = min(max(end, start + 1), total)
+            ranges.append((start, end))
+            start = end
+
+    return ranges
+
+
+def scan_records(file, chars=(), chunk_size=CHUNK_SIZE):
+    '''Yield [name, length, offset, count] of every record in an uncompressed fasta file
+
+    The offset is where the sequence starts, the length leaves out the line
+    breaks and count is the number of the given chars in the sequence. Only
+    bytes.find/bytes.count run over the data, no line is split or copied.
+    '''
+
+    fp = open(file, 'rb')
+    base = 0
+    header = None
+    entry = None
+    at_start = True
+
+    for chunk in read_chunks(fp, chunk_size):
+        pos = 0
+        size = len(chunk)
+
+        while pos < size:
+            if header is not None:
+                end = chunk.find(b"\n", pos)
+                if end < 0:
+                    header.append(chunk[pos:])
+                    break
+                header.append(chunk[pos:end])
+                entry = [get_seqid(b"".join(header)), 0, base+end+1, 0]
+                header = None
+                pos = end + 1
+                at_start = True
+                continue
+
+            if at_start and chunk.startswith(b">", pos):
+                end = pos
+            else:
+                end = chunk.find(b"\n>", pos)
+                end = size if end < 0 else end + 1
+            if entry is not None and end > pos:
+                entry[1] += end - pos
+                for i in LINE_CHARS:
+                    entry[1] -= chunk.count(i, pos, end)
+                for i in chars:
+                    entry[3] += chunk.count(i, pos, end)
+            if end < size:
+                if entry is not None:
+                    yield entry
+                entry = None
+                header = []
+                pos = end + 1
+            else:
+                pos = size
+            at_start = False
+
+        base += size
+        at_start = chunk.endswith(b"\n")
+
+    if header is not None:
+        entry = [get_seqid(b"".join(header)), 0, base, 0]
+    if entry is not None:
+        yield entry
+    fp.close()
+
+
+class FastaWriter(object):
+    '''Write fasta records from chunks of bases, optionally wrapped, and keep
+    the faidx entry [name, length, offset, linebases, linewidth] of each one'''
+
+    def __init__(self, fp, wrap=0):
+
+        self.fp = fp
+        self.wrap = wrap
+        self.offset = 0
+        self.index = []
+        self.name = None
+        self.start = 0
+        self.length = 0
+        self.col = 0
+
+    def _write(self, data):
+
+        self.fp.write(data)
+        self.offset += len(data)
+
+    def start_record(self, name):
+
+        self._write(('>%s\n' % name).encode('utf-8'))
+        self.name = name
+        self.start = self.offset
+        self.length = 0
+        self.col = 0
+
+    def write(self, data):
+
+        wrap = self.wrap
+        self.length += len(data)
+
+        if not wrap:
+            self._write(data)
+            return
+        if self.col + len(data) < wrap:
+            self._write(data)
+            self.col += len(data)
+            return
+
+        first = wrap - self.col
+        lines = [data[:first]]
+        lines += [data[i:i+wrap] for i in range(first, len(data), wrap)]
+        self.col = len(lines[-1]) if len(lines) > 1 else wrap
+        if self.col == wrap:
+            lines.append(b"")
+            self.col = 0
+        self._write(b"\n".join(lines))
+
+    def end_record(self):
+
+        wrap = self.wrap
+        length = self.length
+
+        if not wrap or self.col:
+            self._write(b"\n")
+
+        if wrap and length > wrap:
+            self.index.append([self.name, length, self.start, wrap, wrap+1])
+        elif length:
+            self.index.append([self.name, length, self.start, length, length+1])
+        else:
+            self.index.append([self.name, 0, self.start, 0, 0])
+
+    def write_record(self, name, chunks):
+
+        self.start_record(name)
+        for data in chunks:
+            self.write(data)
+        self.end_record()
+
+    def write_fai(self, file):
+
+        with open(file, 'w') as fo:
+            for entry in self.index:
+                fo.write("%s\n" % "\t".join(map(str, entry)))
+
+
+def compress_member(data, level=6):
+    '''Compress data into one complete gzip member'''
+
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    return compressor.compress(data) + compressor.flush()
+
+
+def compress_bgzf(data, level=6):
+    '''Compress data into BGZF blocks of at most 0xff00 input bytes'''
+
+    blocks = []
+
+    for start in range(0, len(data), BGZF_BLOCK):
+        block = data[start:start+BGZF_BLOCK]
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+        deflate = compressor.compress(block) + compressor.flush()
+        blocks.append(struct.pack("<4sIBBHHHH", b"\x1f\x8b\x08\x04", 0, 0, 0xff, 6, 0x4342, 2, len(deflate)+25))
+        blocks.append(deflate)
+        blocks.append(struct.pack("<II", zlib.crc32(block) & 0xffffffff, len(block)))
+
+    return b"".join(blocks)
+
+
+class GzipWriter(object):
+    '''Write a gzip file whose blocks are compressed on a thread pool
+
+    Every block becomes an independent gzip member, or a run of BGZF blocks
+    with bgzf=True, they are written in the order they were submitted and at
+    most queue_size blocks are pending.
+    '''
+
+    def __init__(self, file, pool, level=6, block_size=GZIP_WRITE_BLOCK, queue_size=GZIP_QUEUE, bgzf=False):
+
+        self.name = file
+        self.fp = open(file, 'wb')
+        self.pool = pool
+        self.level = level
+        self.bgzf = bgzf
+        self.compress = compress_bgzf if bgzf else compress_member
+        self.block_size = block_size
+        self.queue_size = queue_size
+        self.buffer = []
+        self.size = 0
+        self.pending = deque()
+
+    def write(self, data):
+
+        self.buffer.append(data)
+        self.size += len(data)
+        if self.size >= self.block_size:
+            self._submit()
+
+    def _submit(self):
+
+        if self.buffer:
+            self.pending.append(self.pool.submit(self.compress, b"".join(self.buffer), self.level))
+            self.buffer = []
+            self.size = 0
+
+        while self.pending and (len(self.pending) > self.queue_size or self.pending[0].done()):
+            self.fp.write(self.pending.popleft().result())
+
+    def close(self):
+
+        self._submit()
+        while self.pending:
+            self.fp.write(self.pending.popleft().result())
+        if self.bgzf:
+            self.fp.write(BGZF_EOF)
+        self.fp.close()
+
+
+def copy_range(file, start, end, out):
+    '''Copy the bytes [start, end) of file into the file out inside the kernel'''
+
+    with open(file, 'rb') as fi, open(out, 'wb') as fo:
+        src = fi.fileno()
+        dst = fo.fileno()
+        while start < end:
+            count = min(end - start, 1 << 30)
+            if hasattr(os, "copy_file_range"):
+                try:
+                    n = os.copy_file_range(src, dst, count, start)
+                except OSError:
+                    n = os.sendfile(dst, src, start, count)
+            else:
+                n = os.sendfile(dst, src, start, count)
+            if n <= 0:
+                raise Exception("Failed to copy %r at offset %s" % (file, start))
+            start += n
+
+    return out
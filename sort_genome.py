@@ -4,10 +4,11 @@
 import os
 import re
 import sys
-import gzip
 import logging
 import argparse
 
+from seqio import read_fasta, read_fastq, scan_records, FastaWriter
+
 LOG = logging.getLogger(__name__)
 
 __version__ = "1.1.0"
@@ -15,79 +16,109 @@ __author__ = ("Xingguo Zhang",)
 __email__ = "113178210@qq.com"
 __all__ = []
 
+CHUNK_SIZE = 4*1024*1024
+UPPER = bytes.maketrans(b"abcdefghijklmnopqrstuvwxyz", b"ABCDEFGHIJKLMNOPQRSTUVWXYZ")
+GAP = bytes(b"N"[0] if i == b"N"[0] else b"."[0] for i in range(256))
 
-def read_fasta(file):
-    '''Read fasta file'''
 
-    if file.endswith(".gz"):
-        fa = gzip.open(file)
-    elif file.endswith(".fasta") or file.endswith(".fa"):
-        fa = open(file)
-    else:
-        raise Exception("%r file format error" % file)
-
-    seq = ''
-    for line in fa:
-        if type(line) == type(b''):
-            line = line.decode('utf-8')
-        line = line.strip()
-
-        if not line:
-            continue
-        if line.startswith(">"):
-            seq = seq.split('\n')
-            if len(seq)==2:
-                yield seq[0], seq[1]
-            seq = ''
-            line = line.strip(">").split()[0]
-            seq += "%s\n" % line
-            continue
-        seq += line
-
-    seq = seq.split('\n')
-    if len(seq)==2:
-        yield seq[0], seq[1]
-    fa.close()
-
-
-def read_fastq(file):
-    '''Read fastq file'''
-
-    if file.endswith(".gz"):
-        fp = gzip.open(file, 'r')
-    elif file.endswith(".fastq") or file.endswith(".fq"):
-        fp = open(file)
-    else:
-        raise Exception("%r file format error" % file)
-
-    seq = []
-    for line in fp:
-        if type(line) == type(b''):
-            line = line.decode('utf-8')
-        line = line.strip()
-
-        if not line:
-            continue
-        if line.startswith("@") and (len(seq)==0 or len(seq)>=5):
-            seq = []
-            seq.append(line.strip("@").split()[0])
-            continue
-        if line.startswith("@") and len(seq)==4:
-            yield seq[0], seq[1]
-            seq = []
-            seq.append(line.strip("@").split()[0])
-            continue
-        seq.append(line)
-
-    if len(seq)==4:
-        yield seq[0], seq[1]
+def read_record(fp, offset, length, chunk_size=CHUNK_SIZE):
+    '''Yield the upper case sequence of a record in chunks, starting at its byte offset'''
+
+    fp.seek(offset)
+
+    while length > 0:
+        data = fp.read(min(chunk_size, length + (length >> 4) + 2))
+        if not data:
+            raise Exception("Unexpected end of file at offset %s" % fp.tell())
+        data = data.translate(UPPER, b"\r\n")[:length]
+        length -= len(data)
+        yield data
+
+
+def count_bases(chunks, stat):
+    '''Pass the chunks through while counting G+C, N and N gaps into stat'''
+
+    last = b""
+    for data in chunks:
+        stat[0] += len(data)
+        stat[1] += data.count(b"G") + data.count(b"C")
+        stat[2] += data.count(b"N")
+        gaps = data.translate(GAP)
+        stat[3] += gaps.count(b".N")
+        if gaps.startswith(b"N") and last != b"N":
+            stat[3] += 1
+        last = gaps[-1:]
+        yield data
+
+
+def write_genome(records, wrap=0, fai=None, stat=None):
+    '''Rename and write the sorted (nbase, chunks) records, the .fai and
+    statistics of the output are collected while writing'''
+
+    sn = 0
+    cn = 0
+    sys.stdout.flush()
+    writer = FastaWriter(sys.stdout.buffer, wrap)
+    stats = []
+
+    for nbase, chunks in records:
+        if nbase==0:
+            cn += 1
+            seqid = 'contig{0:06d}'.format(cn)
+        else:
+            sn += 1
+            seqid = 'scaffold{0:06d}'.format(sn)
+
+        if stat:
+            stats.append((seqid, [0, 0, 0, 0]))
+            chunks = count_bases(chunks, stats[-1][1])
+        writer.write_record(seqid, chunks)
+
+    sys.stdout.buffer.flush()
+    if fai:
+        writer.write_fai(fai)
+    if stat:
+        fo = open(stat, 'w')
+        fo.write('#Seqid\tLength(bp)\tGC(%)\tN(bp)\tGaps\n')
+        for seqid, (length, gc, nbase, gaps) in stats:
+            fo.write('{0}\t{1}\t{2:.2f}\t{3}\t{4}\n'.format(
+                seqid, length, gc*100.0/max(length-nbase, 1), nbase, gaps))
+        fo.close()
+
+
+def sort_genome_offset(genome, wrap=0, fai=None, stat=None):
+    '''Sort an uncompressed fasta genome without loading the sequences
+
+    The first pass keeps only the offset, length and N count of each record,
+    the second pass copies the records longest first in fixed-size chunks.
+    '''
+
+    records = list(scan_records(genome, (b"N", b"n")))
+    records.sort(key=lambda x: x[1], reverse=True)
+    fp = open(genome, 'rb')
+
+    write_genome(((nbase, read_record(fp, offset, length)) for name, length, offset, nbase in records),
+        wrap, fai, stat)
     fp.close()
 
 
-def sort_genome(genome):
+def encode_records(records):
+    '''Yield the N count and the uppercased bytes of each sequence, one at a time'''
+
+    for seqid, seq in records:
+        seq = seq.upper().encode('utf-8')
+        yield seq.count(b'N'), [seq]
+
+
+def sort_genome(genome, low_memory=False, wrap=0, fai=None, stat=None):
 
     genome_dict = {}
 
+    if low_memory:
+        if genome.endswith(".fasta") or genome.endswith(".fa"):
+            return sort_genome_offset(genome, wrap, fai, stat)
+        LOG.warning("Low memory mode needs an uncompressed fasta file, load %r into memory" % genome)
+
     if genome.endswith(".fastq") or genome.endswith(".fq") or genome.endswith(".fastq.gz") or genome.endswith(".fq.gz"):
         fh = read_fastq(genome)
     elif genome.endswith(".fasta") or genome.endswith(".fa") or genome.endswith(".fasta.gz") or genome.endswith(".fa.gz"):
@@ -98,25 +129,22 @@ def sort_genome(genome):
     for seqid, seq in fh:
         genome_dict[seqid] = seq
 
-    sn = 0
-    cn = 0
-    for line in sorted(genome_dict.items(),key = lambda x:len(x[1]),reverse = True):
-        seq = line[1].upper()
-
-        if seq.count('N')==0:
-            cn += 1
-            seqid = 'contig{0:06d}'.format(cn)
-        else:
-            sn += 1
-            seqid = 'scaffold{0:06d}'.format(sn)
-
-        print('>%s\n%s' % (seqid, seq))
+    write_genome(encode_records(sorted(genome_dict.items(),key = lambda x:len(x[1]),reverse = True)),
+        wrap, fai, stat)
 
 
 def add_help(parser):
 
     parser.add_argument('genome',
         help='Input genome file.')
+    parser.add_argument('--low_memory', action='store_true',
+        help='Sort by byte offsets without holding the genome in memory (uncompressed fasta only).')
+    parser.add_argument('-w', '--wrap', metavar='INT', type=int, default=0,
+        help='Bases per line of the output, default=0 (one line per sequence).')
+    parser.add_argument('--fai', metavar='FILE', type=str, default=None,
+        help='Write the samtools index of the output, stdout must be redirected to a new file.')
+    parser.add_argument('--stat', metavar='FILE', type=str, default=None,
+        help='Write the length, GC, N and gap count of each output sequence.')
 
     return parser
 
@@ -135,6 +163,8 @@ name:
 
 attention:
     sort_genome.py  genome.fa >genome_sort.fa
+    sort_genome.py  genome.fa --low_memory >genome_sort.fa
+    sort_genome.py  genome.fa -w 60 --fai genome_sort.fa.fai --stat genome_sort.stat.tsv >genome_sort.fa
 
 version: %s
 contact:  %s <%s>\
@@ -142,7 +172,7 @@ contact:  %s <%s>\
 
     args = add_help(parser).parse_args()
 
-    sort_genome(args.genome)
+    sort_genome(args.genome, args.low_memory, args.wrap, args.fai, args.stat)
 
 
 if __name__ == "__main__":
@@ -4,14 +4,19 @@
 import os
 import re
 import sys
-import gzip
 import json
-import pysam
 import logging
 import argparse
 
 import collections
 
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+from seqio import open_file, iter_fasta, iter_fastq, GZIP_THREADS
+from readstat import new_lengths, read_bam_lengths, cached_counts, stat_counts, write_hist, \
+    is_hist, new_stat, LengthStat, NX_LEVELS, HIST_SUFFIX
+from statcache import open_cache
+
 LOG = logging.getLogger(__name__)
 
 __version__ = "1.2.0"
@@ -20,146 +25,107 @@ __email__ = "113178210@qq.com"
 __all__ = []
 
 
-def read_fasta(file):
-    '''Read fasta file'''
+def read_length(file, threads=None):
+    '''Return the read lengths of a file as an unsigned int array
 
-    if file.endswith(".gz"):
-        fp = gzip.open(file)
-    elif file.endswith(".fasta") or file.endswith(".fa"):
-        fp = open(file)
-    else:
-        raise Exception("%r file format error" % file)
+    threads None keeps the default threads of the gzip reader and one pysam thread.
+    '''
 
-    seq = ''
-
-    for line in fp:
-        if type(line) == type(b''):
-            line = line.decode('utf-8')
-        line = line.strip()
-
-        if not line:
-            continue
-        if not seq:
-            seq += "%s\n" % line.strip(">").split()[0]
-            continue
-        if line.startswith(">"):
-            line = line.strip(">").split()[0]
-            seq = seq.split('\n')
-
-            yield [seq[0], seq[1]]
-            seq = ''
-            seq += "%s\n" % line
-        else:
-            seq += line
-
-    seq = seq.split('\n')
-    if len(seq)==2:
-        yield [seq[0], seq[1]]
-    fp.close()
-
-
-def read_fastq(file):
-    '''Read fastq file'''
-
-    if file.endswith(".gz"):
-        fp = gzip.open(file)
-    elif file.endswith(".fastq") or file.endswith(".fq"):
-        fp = open(file)
+    length = new_lengths()
+
+    if file.endswith(".fasta") or file.endswith(".fa") or file.endswith(".fa.gz") or file.endswith(".fasta.gz"):
+        fp = open_file(file, threads or GZIP_THREADS)
+        length.extend(len(seq) for header, seq in iter_fasta(fp))
+        fp.close()
+    elif file.endswith(".fastq") or file.endswith(".fq") or file.endswith(".fq.gz") or file.endswith(".fastq.gz"):
+        fp = open_file(file, threads or GZIP_THREADS)
+        length.extend(len(record[1]) for record in iter_fastq(fp))
+        fp.close()
+    elif file.endswith(".bam") or file.endswith(".sam"):
+        length = read_bam_lengths(file, threads or 1)
     else:
         raise Exception("%r file format error" % file)
 
-    seq = []
-
-    for line in fp:
-        if type(line) == type(b''):
-            line = line.decode('utf-8')
-        line = line.strip()
-
-        if not line:
-            continue
-        if line.startswith('@') and (len(seq)==0 or len(seq)>=5):
-            seq.append(line.strip("@").split()[0])
-            continue
-        if line.startswith('@') and len(seq)==4:
-            yield seq
-            seq = []
-            seq.append(line.strip("@").split()[0])
-        else:
-            seq.append(line)
+    return length
 
-    if len(seq)==4:
-        yield seq
-    fp.close()
 
+def get_sample(file):
 
-def read_bam(file):
+    name = file.split('/')[-1]
 
-    if file.endswith(".bam"):
-        fh = pysam.AlignmentFile(file, "rb", check_sq=False)
-    elif file.endswith(".sam"):
-        fh = pysam.AlignmentFile(file, 'r')
+    if '--' in name:
+        name = name.split('--')[1].split('.bam')[0]
     else:
-        raise Exception("%r file format error" % file)
+        name = name.split('.')[0]
 
-    for line in fh:
-        yield [line.qname, line.seq]
+    return name
 
-    fh.close()
 
+def stat_file(file, threads=None, cache=None, hist=False, alpha=None):
+    '''Return the summary of a file, only this small tuple is sent back from a worker
 
-def n50(lengths):
+    With alpha (0 for exact, > 0 for a LengthSketch) the length statistics of
+    the file are returned as well, to be merged into the total.
+    '''
 
-    sum_length = sum(lengths)
-    accu_length = 0
+    counts = cached_counts(file, cache, read_length, threads)
+    if hist and not is_hist(file):
+        write_hist("%s%s" % (get_sample(file), HIST_SUFFIX), counts)
 
-    for i in sorted(lengths, reverse=True):
-        accu_length += i
+    stat = None
+    if alpha is not None:
+        stat = new_stat(alpha)
+        stat.update(LengthStat(counts))
 
-        if accu_length >= sum_length*0.5:
-            return i
+    return stat_counts(counts), stat
 
 
-def read_length(file):
+def stat_files(files, jobs=1, threads=None, cache=None, hist=False, alpha=None):
+    '''Yield the summary of every file in input order, on a process pool when jobs > 1'''
 
-    length = []
+    task = partial(stat_file, threads=threads, cache=cache, hist=hist, alpha=alpha)
 
-    if file.endswith(".fasta") or file.endswith(".fa") or file.endswith(".fa.gz") or file.endswith(".fasta.gz"):
-        fh = read_fasta(file)
-    elif file.endswith(".fastq") or file.endswith(".fq") or file.endswith(".fq.gz") or file.endswith(".fastq.gz"):
-        fh = read_fastq(file)
-    elif file.endswith(".bam") or file.endswith(".sam"):
-        fh = read_bam(file)
-    else:
-        raise Exception("%r file format error" % file)
-
-    for line in fh:
-        length.append(len(line[1]))
+    if jobs <= 1 or len(files) <= 1:
+        for file in files:
+            yield task(file)
+        return
 
-    return length
+    with ProcessPoolExecutor(max_workers=min(jobs, len(files))) as pool:
+        for result in pool.map(task, files):
+            yield result
 
 
-def stat_reads(files, out):
+def stat_reads(files, out, nx=False, jobs=1, threads=None, cache=None, hist=False, total=False, alpha=0):
 
     title = ["Sample", "Bases(bp)", "Reads number", "Mean Length(bp)", "N50(bp)", "Longest(bp)"]
+    if nx:
+        title += ["N%s(bp)" % i for i in NX_LEVELS if i != 50]
     data = collections.OrderedDict()
     sample = collections.OrderedDict()
     fo = open(out, 'w')
-    fo.write('Sample\tBases(bp)\tReads number\tMean Length(bp)\tN50(bp)\tLongest(bp)\n')
-    for file in files:
-        name = file.split('/')[-1]
-
-        if '--' in name:
-            name = name.split('--')[1].split('.bam')[0]
-        else:
-            name = name.split('.')[0]
+    fo.write('%s\n' % '\t'.join(title))
+
+    def add_row(name, result):
+
         data[name] = collections.OrderedDict()
-        sample[name] = [name, "", ""]
-        length = read_length(file)
+        bases, number, mean, longest, nxlen = result
 
-        fo.write('{0}\t{1:,}\t{2:,}\t{3:,}\t{4:,}\t{5:,}\n'.format(name, sum(length), len(length), sum(length)/len(length), n50(length), max(length)))
-        line = [name, sum(length), len(length), sum(length)/len(length), n50(length), max(length)]
+        line = [name, bases, number, mean, nxlen[50], longest]
+        if nx:
+            line += [nxlen[i] for i in NX_LEVELS if i != 50]
+        fo.write('%s\n' % '\t'.join([name] + ['{0:,}'.format(i) for i in line[1:]]))
         for i in range(len(title)-1):
             data[name][title[i+1]] = line[i+1]
+
+    merged = new_stat(alpha) if total else None
+    for file, (result, stat) in zip(files, stat_files(files, jobs, threads, cache, hist, alpha if total else None)):
+        name = get_sample(file)
+        sample[name] = [name, "", ""]
+        add_row(name, result)
+        if total:
+            merged.update(stat)
+    if total:
+        add_row("Total", merged.stat())
     fo.close()
     print("field = %s" % json.dumps(title))
     print("summary = %s" % json.dumps(data))
@@ -169,9 +135,25 @@ def stat_reads(files, out):
 def add_hlep_args(parser):
 
     parser.add_argument('-i', '--input', nargs='+', metavar='FILE', type=str, required=True,
-        help='Input reads file, format(fasta,fastq,fa.gz,bam and sam).')
+        help='Input reads file, format(fasta,fastq,fa.gz,bam,sam and lenhist).')
     parser.add_argument('-o', '--out', metavar='STR', type=str, default="out.tsv",
         help='Out name')
+    parser.add_argument('--nx', action='store_true',
+        help='Also report the N10 to N90 read lengths.')
+    parser.add_argument('-j', '--jobs', metavar='INT', type=int, default=1,
+        help='Number of files counted at the same time, default=1.')
+    parser.add_argument('-t', '--threads', metavar='INT', type=int, default=None,
+        help='Decompression threads for each bam or gzip file, default=1 for bam and %s for gzip.' % GZIP_THREADS)
+    parser.add_argument('--total', action='store_true',
+        help='Add a Total row with the statistics of all inputs together.')
+    parser.add_argument('--sketch', metavar='FLOAT', type=float, default=0,
+        help='Merge the Total row from log bucket sketches with this relative error (e.g. 0.01), default=0 (exact).')
+    parser.add_argument('--hist', action='store_true',
+        help='Write the read length histogram of every input to sample.lenhist.')
+    parser.add_argument('--no-cache', dest='no_cache', action='store_true',
+        help='Do not read or write the statistics cache.')
+    parser.add_argument('--refresh', action='store_true',
+        help='Recount the inputs and replace their cache entries.')
 
     return parser
 
@@ -192,13 +174,24 @@ attention:
     stat_barcode.py -i *.bam
     stat_barcode.py -i *.fa
     stat_barcode.py -i *.fq
+    stat_barcode.py -i *.fq --nx -o stat.tsv
+    stat_barcode.py -i *.bam --jobs 8
+    stat_barcode.py -i cell.bam --threads 8
+    stat_barcode.py -i *.bam --hist && stat_barcode.py -i *.lenhist
+    stat_barcode.py -i */*.bam --jobs 16 --total --sketch 0.01
+
+    The lengths of a bam are read from its PacBio index (cell.bam.pbi) when it exists.
+    The length histogram of every input is cached (~/.cache/stat_reads, or STAT_CACHE_DIR)
+    and reused while the file is unchanged.
 version: %s
 contact:  %s <%s>\
         ''' % (__version__, ' '.join(__author__), __email__))
 
     args = add_hlep_args(parser).parse_args()
 
-    stat_reads(args.input, args.out)
+    cache = open_cache(args.no_cache, args.refresh)
+    stat_reads(args.input, args.out, args.nx, args.jobs, args.threads, cache, args.hist,
+        args.total, args.sketch)
 
 
 if __name__ == "__main__":
@@ -8,6 +8,7 @@ import logging
 import argparse
 
 from collections import OrderedDict
+from seqio import read_fasta
 
 LOG = logging.getLogger(__name__)
 
@@ -30,34 +31,6 @@ def read_tsv(file, sep=None):
         yield line.split(sep)
 
 
-def read_fasta(file):
-    '''Read fasta file'''
-
-    if file.endswith("gz"):
-        fp = gzip.open(file)
-    else:
-        fp = open(file)
-
-    seq = ''
-    for line in fp:
-        if type(line) == type(b''):
-            line = line.decode('utf-8')
-        line = line.strip()
-
-        if not line or line.startswith("#"):
-            continue
-        if line.startswith(">"):
-            if seq!='':
-                yield seq.split('\n')
-            seq = "%s\n" % line
-            continue
-        seq += line
-
-    if seq!='':
-        yield seq.split('\n')
-    fp.close()
-
-
 def get_sample(file):
 
     name = file.split('/')[-1]
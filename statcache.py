@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import struct
+import hashlib
+import logging
+
+from array import array
+
+LOG = logging.getLogger(__name__)
+
+__version__ = "1.0.0"
+__author__ = ("Xingguo Zhang",)
+__email__ = "113178210@qq.com"
+__all__ = ["StatCache", "open_cache", "file_key"]
+
+
+CACHE_DIR = os.environ.get("STAT_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "stat_reads"))
+CACHE_SIZE = int(os.environ.get("STAT_CACHE_SIZE", 1024*1024*1024))
+CACHE_MAGIC = b"RSC1"
+CACHE_HEADER = struct.Struct("<4sBcQ")
+HASH_SIZE = 64*1024
+
+
+def file_key(file, kind, fast_hash=True):
+    '''Return the cache key of a file, from its absolute path, size and mtime
+
+    With fast_hash the first and last 64 kb of the file are hashed as well,
+    so a file rewritten with the same size and mtime gets a new key.
+    '''
+
+    path = os.path.abspath(file)
+    stat = os.stat(path)
+    key = hashlib.sha1(("%s\t%s\t%s\t%s" % (path, stat.st_size, stat.st_mtime_ns, kind)).encode('utf-8'))
+
+    if fast_hash:
+        with open(path, 'rb') as fp:
+            key.update(fp.read(HASH_SIZE))
+            if stat.st_size > HASH_SIZE:
+                fp.seek(max(stat.st_size-HASH_SIZE, HASH_SIZE))
+                key.update(fp.read(HASH_SIZE))
+
+    return key.hexdigest()
+
+
+def read_arrays(data):
+    '''Return the arrays stored in a cache entry, None when the data is not an entry'''
+
+    values = []
+    offset = 0
+    while offset < len(data):
+        magic, order, code, number = CACHE_HEADER.unpack_from(data, offset)
+        if magic != CACHE_MAGIC:
+            return None
+        offset += CACHE_HEADER.size
+        value = array(code.decode('ascii'))
+        size = value.itemsize*number
+        value.frombytes(data[offset:offset+size])
+        if len(value) != number:
+            return None
+        if order != (sys.byteorder == "little"):
+            value.byteswap()
+        values.append(value)
+        offset += size
+
+    return values
+
+
+class StatCache(object):
+    '''On-disk cache of the arrays computed from the input files
+
+    Each entry is a small binary file named by file_key, holding one or more
+    arrays. A hit touches the entry, and when the cache grows beyond
+    max_size the least recently used entries are removed.
+    '''
+
+    def __init__(self, path=CACHE_DIR, max_size=CACHE_SIZE, refresh=False):
+
+        self.path = path
+        self.max_size = max_size
+        self.refresh = refresh
+
+    def entry(self, file, kind):
+
+        return os.path.join(self.path, "%s.%s" % (file_key(file, kind), kind))
+
+    def load(self, file, kind):
+        '''Return the list of arrays cached for the file, None on a miss'''
+
+        if self.refresh:
+            return None
+
+        entry = self.entry(file, kind)
+        try:
+            with open(entry, 'rb') as fp:
+                data = fp.read()
+        except (IOError, OSError):
+            return None
+
+        try:
+            values = read_arrays(data)
+        except (struct.error, ValueError):
+            values = None
+        if values is None:
+            LOG.warning("Ignore the broken cache entry %r" % entry)
+            return None
+
+        try:
+            os.utime(entry, None)
+        except OSError:
+            pass
+        LOG.info("Load %s of %r from the cache" % (kind, file))
+
+        return values
+
+    def save(self, file, kind, values):
+        '''Cache a list of arrays for the file, the entry is replaced atomically'''
+
+        entry = self.entry(file, kind)
+        temp = "%s.%s.tmp" % (entry, os.getpid())
+
+        try:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            with open(temp, 'wb') as fo:
+                for value in values:
+                    fo.write(CACHE_HEADER.pack(CACHE_MAGIC, sys.byteorder == "little",
+                        value.typecode.encode('ascii'), len(value)))
+                    fo.write(value.tobytes())
+            os.replace(temp, entry)
+        except (IOError, OSError) as error:
+            LOG.warning("Can not write the cache entry %r: %s" % (entry, error))
+            return
+        self.evict()
+
+    def evict(self):
+        '''Remove the least recently used entries until the cache fits in max_size'''
+
+        entries = []
+        total = 0
+        for name in os.listdir(self.path):
+            if name.endswith(".tmp"):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.path, name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+            total += stat.st_size
+
+        entries.sort()
+        for mtime, size, name in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(os.path.join(self.path, name))
+            except OSError:
+                pass
+            total -= size
+
+
+def open_cache(no_cache=False, refresh=False):
+    '''Return the StatCache selected by the --no-cache/--refresh options, None for no cache'''
+
+    if no_cache:
+        return None
+
+    return StatCache(refresh=refresh)